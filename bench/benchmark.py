@@ -0,0 +1,223 @@
+import argparse, asyncio, json, logging, multiprocessing, os, platform, random, resource, sqlite3, statistics, sys, tempfile, time
+from concurrent.futures import ProcessPoolExecutor
+
+# Measures how the bot behaves with a lot of parcels: a synthetic database, a fake courier API running in its
+# own process, and a stubbed Discord client. Every size runs in a fresh process so peak memory is per size.
+#
+#   python bench/benchmark.py --sizes 1000,10000,100000
+#
+# The results are written as json (bench/results/ by default) so runs can be compared over time.
+
+SRC_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+COURIERS = ["acs", "couriercenter", "easymail", "skroutz", "elta", "speedex", "geniki"]
+
+def _event(index: int) -> dict:
+    return {
+        "location": f"Hub {index}",
+        "description": f"Scan {index}",
+        "datetime": f"2024-01-01T{index % 24:02d}:{index % 60:02d}:00",
+    }
+
+def _run_tracker(port: int, latency: float, error_rate: float, move_probability: float):
+    # Fake courier API. Every lookup of an id may add an event to it, so parcels move over time.
+    from aiohttp import web
+
+    events = {}
+
+    def package(id: str) -> dict:
+        count = events.get(id, 1)
+        if random.random() < move_probability:
+            count += 1
+        events[id] = count
+        return {"found": True, "delivered": False, "courier_icon": "", "locations": [_event(i) for i in range(count)]}
+
+    async def respond(ids: list):
+        await asyncio.sleep(random.uniform(latency * 0.5, latency * 1.5))
+        if random.random() < error_rate:
+            return web.Response(status=503)
+        return web.json_response({"data": {id: package(id) for id in ids}})
+
+    async def track_one(request: web.Request):
+        return await respond([request.match_info["id"]])
+
+    async def track_many(request: web.Request):
+        return await respond(request.query.get("ids", "").split(","))
+
+    app = web.Application()
+    app.router.add_get("/track-one/{courier}/{id}", track_one)
+    app.router.add_get("/track-many/{courier}", track_many)
+    web.run_app(app, host="127.0.0.1", port=port, print=None, access_log=None)
+
+def _generate_database(path: str, parcels: int, guilds: int, overlap: float):
+    # Every parcel is tracked by one guild, and `overlap` of them by a second guild as well
+    conn = sqlite3.connect(path)
+    with conn:
+        conn.executemany("INSERT INTO Guilds (guild_id, updates_channel) VALUES (?, ?)", [(str(g), str(10**6 + g)) for g in range(guilds)])
+
+        event = _event(0)
+        conn.executemany(
+            "INSERT INTO Shipments (id, courier_name, tracking_id, location, description, datetime) VALUES (?, ?, ?, ?, ?, ?)",
+            ((i, COURIERS[i % len(COURIERS)], f"BENCH{i:08d}", event["location"], event["description"], event["datetime"]) for i in range(1, parcels + 1))
+        )
+
+        subscriptions = []
+        for i in range(1, parcels + 1):
+            guild = random.randrange(guilds)
+            subscriptions.append((i, str(guild), f"Parcel {i}"))
+            if guilds > 1 and random.random() < overlap:
+                subscriptions.append((i, str((guild + random.randrange(1, guilds)) % guilds), f"Shared parcel {i}"))
+        conn.executemany("INSERT INTO Subscriptions (shipment_id, guild_id, description) VALUES (?, ?, ?)", subscriptions)
+    conn.close()
+
+class _Channel:
+    def __init__(self, id: int):
+        self.id = id
+
+    async def send(self, embeds: list = None, **kwargs):
+        pass
+
+class _Bot:
+    def get_channel(self, id: int):
+        return _Channel(id)
+
+    async def fetch_channel(self, id: int):
+        return _Channel(id)
+
+def _run_size(options: dict, parcels: int) -> dict:
+    directory = tempfile.mkdtemp(prefix="courier-bench-")
+    database = options["database"] or os.path.join(directory, "data.sqlite3")
+    if os.path.exists(database):
+        os.remove(database)
+
+    # The bot's modules read their settings on import. Everything is due at once and nothing is spread out,
+    # so a cycle measures how fast the whole set can be polled.
+    os.environ.update({
+        "DATABASE_PATH": database,
+        "TRACKER_URL": f"http://127.0.0.1:{options['port']}",
+        "SCHEDULER_SLOT": "0",
+        "POLLER_MAX_PER_SLOT": str(parcels),
+        "NOTIFY_LINGER": "0",
+    })
+    sys.path.insert(0, SRC_PATH)
+    import helpers, notifications, poller, sqlite3_handler, tracker
+
+    # With everything due at once every cycle "overruns" the slot, so only errors are of interest
+    logger = logging.getLogger("benchmark")
+    logger.setLevel(logging.ERROR)
+
+    helpers.check_database(logger)
+    generate_started = time.perf_counter()
+    _generate_database(database, parcels, options["guilds"], options["overlap"])
+    generate_time = time.perf_counter() - generate_started
+
+    statements = 0
+    def count_statement(statement: str):
+        nonlocal statements
+        statements += 1
+    sqlite3_handler.get_connection().set_trace_callback(count_statement)
+
+    async def run() -> dict:
+        # The rate limits are Discord's concern, the benchmark only measures the bot's side
+        notifications.CHANNEL_RATE = notifications.GLOBAL_RATE = (10**9, 1.0)
+        dispatcher = notifications.Dispatcher(logger, _Bot())
+        dispatcher.start()
+
+        cycles = []
+        for _ in range(options["cycles"]):
+            conn = sqlite3_handler.get_connection()
+            with conn:
+                conn.execute("UPDATE Shipments SET next_check_at = 0")
+            helpers.results_cache.entries.clear()
+
+            nonlocal statements
+            statements = 0
+            started = time.perf_counter()
+            await poller.run_cycle(logger)
+            duration = time.perf_counter() - started
+            cycle_statements = statements
+
+            (queued,) = conn.execute("SELECT COUNT(*) FROM Outbox").fetchone()
+            sent = dispatcher.sent
+            await dispatcher.poll_outbox()
+            while dispatcher.sent + dispatcher.failed - sent < queued:
+                await asyncio.sleep(0.01)
+            await dispatcher.poll_outbox()
+
+            cycles.append({"duration": duration, "statements": cycle_statements, "notifications": queued})
+
+        # /list: the query plus rendering the page the paginator opens on
+        list_latencies = []
+        for guild in random.sample(range(options["guilds"]), min(options["guilds"], 20)):
+            started = time.perf_counter()
+            rows = await sqlite3_handler.get_packages_for_guild_id(logger, str(guild))
+            if rows:
+                helpers.PackagePages(rows)[0]
+            list_latencies.append(time.perf_counter() - started)
+
+        await tracker.close_session()
+        await sqlite3_handler.close()
+
+        return {
+            "cycles": cycles,
+            "list_latency": {
+                "p50": statistics.median(list_latencies),
+                "max": max(list_latencies),
+            },
+        }
+
+    result = asyncio.run(run())
+    result.update({
+        "parcels": parcels,
+        "generate_time": generate_time,
+        # ru_maxrss is in kilobytes on Linux
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    })
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark polling and /list against a synthetic database")
+    parser.add_argument("--sizes", default="1000,10000,100000", help="Comma separated parcel counts")
+    parser.add_argument("--guilds", type=int, default=100)
+    parser.add_argument("--overlap", type=float, default=0.1, help="Share of parcels tracked by two guilds")
+    parser.add_argument("--cycles", type=int, default=3, help="Poll cycles per size, the first one also stores the history")
+    parser.add_argument("--latency", type=float, default=0.05, help="Average fake tracker response time in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.01)
+    parser.add_argument("--move-probability", type=float, default=0.1, help="Chance that a lookup finds a new event")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--database", default=None, help="Where to create the synthetic database (replaced on every size), a temporary file by default")
+    parser.add_argument("--output", default=None, help="Results file, bench/results/<time>.json by default")
+    args = parser.parse_args()
+
+    options = vars(args)
+    sizes = [int(size) for size in args.sizes.split(",")]
+    context = multiprocessing.get_context("spawn")
+
+    tracker_process = context.Process(target=_run_tracker, args=(args.port, args.latency, args.error_rate, args.move_probability), daemon=True)
+    tracker_process.start()
+    time.sleep(1)
+
+    results = []
+    try:
+        for size in sizes:
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                result = executor.submit(_run_size, options, size).result()
+
+            cycles = ", ".join(f"{cycle['duration']:.2f}s" for cycle in result["cycles"])
+            print(f"{size} parcels: cycles {cycles}, /list p50 {result['list_latency']['p50'] * 1000:.1f}ms, peak rss {result['peak_rss_mb']:.0f}MB")
+            results.append(result)
+    finally:
+        tracker_process.terminate()
+
+    output = args.output or os.path.join(os.path.dirname(os.path.abspath(__file__)), "results", f"{time.strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump({
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "options": options,
+            "results": results,
+        }, f, indent=4)
+    print(f"Results written to {output}")
+
+if __name__ == "__main__":
+    main()
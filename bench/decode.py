@@ -0,0 +1,49 @@
+import argparse, json, os, random, sys, time, tracemalloc
+
+# Measures the CPU time and memory it takes to turn a tracker response into a TrackingResult, which the
+# poller does for every id it checks. The responses carry fields the bot doesn't use, like the real ones.
+#
+#   python bench/decode.py --lookups 10000
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+import helpers, tracker
+
+def _response(id: str, events: int) -> bytes:
+    locations = [
+        {"location": f"Hub {i}", "description": f"Scan {i}", "datetime": f"2024-01-01T{i % 24:02d}:00:00", "status_code": i, "extra": {"branch": i}}
+        for i in range(events)
+    ]
+    package = {"found": True, "delivered": False, "courier_icon": "https://example.com/icon.png", "courier": "acs", "locations": locations}
+    return json.dumps({"data": {id: package}}).encode()
+
+def _lookup(id: str, body: bytes):
+    return helpers.parse_package(id, tracker.decode_response(body).data[id])
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark decoding tracker responses")
+    parser.add_argument("--lookups", type=int, default=10000)
+    parser.add_argument("--max-events", type=int, default=12, help="Every response has between 1 and this many events")
+    parser.add_argument("--rounds", type=int, default=5, help="The fastest round is reported")
+    args = parser.parse_args()
+
+    random.seed(0)
+    responses = [(f"ID{i:08d}", _response(f"ID{i:08d}", random.randint(1, args.max_events))) for i in range(args.lookups)]
+
+    cpu_times = []
+    for _ in range(args.rounds):
+        started = time.process_time()
+        for id, body in responses:
+            _lookup(id, body)
+        cpu_times.append(time.process_time() - started)
+
+    # Memory is traced separately, tracing slows everything down
+    tracemalloc.start()
+    results = [_lookup(id, body) for id, body in responses]
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print(f"{args.lookups} lookups: {min(cpu_times) / args.lookups * 10**6:.1f}us cpu per lookup, "
+          f"{retained / len(results):.0f} bytes kept per result, peak {peak / 2**20:.1f}MB")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,43 @@
+import time
+from collections import OrderedDict
+
+class TTLCache:
+    # LRU cache whose entries also expire. Every entry can have its own ttl, and readers can ask
+    # for something fresher than that with max_age.
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, max_age: float = None):
+        # Returns (hit, value). A miss is also counted when the entry exists but is too old.
+        entry = self.entries.get(key)
+        if entry is not None:
+            stored_at, ttl, value = entry
+            age = time.monotonic() - stored_at
+            if age < ttl and (max_age is None or age < max_age):
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return True, value
+
+            if age >= ttl:
+                del self.entries[key]
+
+        self.misses += 1
+        return False, None
+
+    def put(self, key, value, ttl: float = None):
+        self.entries[key] = (time.monotonic(), self.ttl if ttl is None else ttl, value)
+        self.entries.move_to_end(key)
+
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def discard(self, key):
+        self.entries.pop(key, None)
@@ -1,12 +1,12 @@
-import discord, requests, sqlite3, logging, json, datetime
+import discord, asyncio, logging, datetime, hashlib, csv, msgspec, re
 from dateutil import parser
 from os import getenv
-from os.path import exists
 from discord.ext import pages
+from typing import Dict, List
+from collections import defaultdict
+from collections.abc import Sequence
 
-import models, sqlite3_handler
-
-TRACKER_URL = getenv("TRACKER_URL", "https://courier-api.danielpikilidis.com")
+import models, sqlite3_handler, migrations, tracker, cache, metrics
 
 courier_urls = {
     "acs": "https://www.acscourier.net/el/web/greece/track-and-trace?action=getTracking3&generalCode=",
@@ -18,28 +18,59 @@ courier_urls = {
     "geniki": "https://www.taxydromiki.com/en/track/",
 }
 
-async def send_status(logger: logging.Logger, package: models.TrackingResult, courier_name: str, guild_id: str = "", ctx: discord.ApplicationContext = None, bot: discord.Bot = None, channel_id: str = ""):
-    if package is None:
-        await ctx.respond("Failed to retrieve package info, please try again.")
-        return
-    
-    if package.found == False:
-        await ctx.respond(f"Package ({package.id}) not found")
-        return
-    
-    if guild_id != "":
-        description = sqlite3_handler.get_description_for_tracking_id(logger, guild_id, package.id)
-        if description is None:
-            description = package.id
-    else:
-        description = package.id
+# Tracking id formats each courier is known to use. They only decide which couriers are asked about an id first,
+# the rest are asked if none of those finds it (the formats are guesses, couriers don't publish them).
+COURIER_ID_PATTERNS = {
+    "acs": [r"\d{10}"],
+    "couriercenter": [r"\d{9,12}", r"[A-Z]{2}\d{9,10}"],
+    "easymail": [r"\d{9,12}"],
+    "skroutz": [r"(?=.*[A-Z])[A-Z0-9]{10,14}"],
+    "elta": [r"[A-Z]{2}\d{9}[A-Z]{2}", r"\d{11,13}"],
+    "speedex": [r"\d{9,12}"],
+    "geniki": [r"\d{10}"],
+}
+
+_courier_id_index = [
+    (courier, re.compile("|".join(f"(?:{pattern})" for pattern in patterns)))
+    for courier, patterns in COURIER_ID_PATTERNS.items()
+]
+
+def candidate_couriers(id: str) -> List[List[str]]:
+    # The couriers to ask about an id, in rounds: the ones whose format fits it, then everyone else
+    id = id.strip().upper()
+    candidates = [courier for courier, pattern in _courier_id_index if pattern.fullmatch(id)]
+    rest = [courier for courier in courier_urls if courier not in candidates]
+    return [candidates, rest] if candidates and rest else [candidates or rest]
+
+# Discord's limit for an embed's description
+EMBED_DESCRIPTION_LIMIT = 4096
+
+def _format_event(location: models.Location) -> str:
+    try:
+        date = parser.isoparse(location.datetime).strftime("%d-%m-%Y, %H:%M")
+    except (ValueError, TypeError):
+        date = location.datetime
+    return f"`{date}` {location.location}: {location.description}"
 
+def status_embed(package: models.TrackingResult, courier_name: str, description: str = None, events: List[models.Location] = None, history_limit: int = EMBED_DESCRIPTION_LIMIT) -> discord.Embed:
     embed = discord.Embed(
-        title=description,
+        title=package.id if description is None else description,
         url=courier_urls[courier_name] + package.id,
         color=0xFFFFFF
     )
 
+    if events:
+        # Events before the last location, newest first, as many as fit
+        lines = []
+        length = 0
+        for location in reversed(events):
+            line = _format_event(location)
+            length += len(line) + 1
+            if length > history_limit:
+                break
+            lines.append(line)
+        embed.description = "\n".join(lines)
+
     embed.add_field(name="Location", value=package.last_location.location, inline=True)
     embed.add_field(name="Description", value=package.last_location.description, inline=True)
 
@@ -47,54 +78,370 @@ async def send_status(logger: logging.Logger, package: models.TrackingResult, co
     embed.add_field(name="Date", value=date.strftime("%d-%m-%Y, %H:%M"), inline=False)
 
     embed.set_thumbnail(url=package.courier_icon)
-    
-    if ctx is None:
-        channel = bot.get_channel(int(channel_id))
-        await channel.send(embed=embed)
-    else:
-        await ctx.respond(embed=embed)
 
+    return embed
 
-async def retrieve_package_info(logger: logging.Logger, courier: str, id: str) -> models.TrackingResult:
-    try:
-        logger.debug(f"Requesting data from {TRACKER_URL}/track-one/{courier}/{id}")
-        res = requests.get(f"{TRACKER_URL}/track-one/{courier}/{id}", timeout=2.5)
-    except requests.exceptions.Timeout:
-        return None
-    
-    if res.status_code >= 500:
-        logger.debug(f"Request failed with status code {res.status_code}")
-        return None
+async def send_status(logger: logging.Logger, id: str, courier_name: str, ctx: discord.ApplicationContext, history: bool = False):
+    await ctx.respond(embed=await _track_embed(logger, courier_name, id, history))
 
-    data = res.json()["data"]
-    package = data[id]
 
-    if package["found"] == False:
-        return None
+TRACKER_CACHE_SIZE = int(getenv("TRACKER_CACHE_SIZE", "10000"))
+TRACKER_CACHE_TTL = float(getenv("TRACKER_CACHE_TTL", "120"))
+TRACKER_CACHE_NOT_FOUND_TTL = float(getenv("TRACKER_CACHE_NOT_FOUND_TTL", "60"))
+TRACKER_CACHE_ERROR_TTL = float(getenv("TRACKER_CACHE_ERROR_TTL", "15"))
+
+# Recent lookups keyed by (courier, id). Ids that weren't found (found=False) and lookups that
+# failed (None) are cached too, for a shorter time.
+results_cache = cache.TTLCache(TRACKER_CACHE_SIZE, TRACKER_CACHE_TTL)
+
+# Lookups currently running, keyed by (courier, id). See _coalesce.
+_in_flight: Dict[tuple, asyncio.Task] = {}
+
+# How many callers are waiting on each running lookup, the last one to stop waiting cancels it. See _coalesce.
+_waiters: Dict[asyncio.Task, int] = defaultdict(int)
+
+DETECTION_CACHE_SIZE = int(getenv("DETECTION_CACHE_SIZE", "10000"))
+DETECTION_CACHE_TTL = float(getenv("DETECTION_CACHE_TTL", str(7 * 24 * 60 * 60)))
+
+# The courier each auto detected id belongs to
+detection_cache = cache.TTLCache(DETECTION_CACHE_SIZE, DETECTION_CACHE_TTL)
 
-    if len(package["locations"]) == 0:
+async def _collect_cache_metrics():
+    for name, lookups in (("results", results_cache), ("detection", detection_cache)):
+        metrics.cache_hits.set(lookups.hits, cache=name)
+        metrics.cache_misses.set(lookups.misses, cache=name)
+        metrics.cache_entries.set(len(lookups), cache=name)
+
+# Every process that serves metrics (the bot and each poller worker) has its own caches
+metrics.add_collector(_collect_cache_metrics)
+
+TRACKER_BATCH_RETRY = float(getenv("TRACKER_BATCH_RETRY", "3600"))
+
+# Couriers for which the tracker has rejected batch requests, these go through track-one until batching is
+# tried again TRACKER_BATCH_RETRY seconds later (the rejection may have been a deploy, not a missing endpoint)
+_batch_unsupported = cache.TTLCache(len(courier_urls), TRACKER_BATCH_RETRY)
+
+_package_decoder = msgspec.json.Decoder(models.TrackerPackage)
+
+def parse_package(id: str, package: msgspec.Raw) -> models.TrackingResult:
+    # package is the id's undecoded entry in the response. Raises msgspec.ValidationError if it's malformed.
+    # An id the courier doesn't know is a result with found=False, None is left for lookups that failed.
+    package = _package_decoder.decode(package)
+
+    locations = package.locations
+
+    if len(locations) == 0:
         last_location = models.Location(
             location="Unknown",
             description="Unknown",
             datetime=datetime.datetime.fromtimestamp(0).isoformat()
         )
     else:
-        last_location = models.Location(
-            location=package["locations"][-1]["location"],
-            description=package["locations"][-1]["description"],
-            datetime=package["locations"][-1]["datetime"]
-        )
+        last_location = locations[-1]
 
     return models.TrackingResult(
         id=id,
-        courier_icon=package["courier_icon"],
-        found=package["found"],
-        delivered=package["delivered"],
-        last_location=last_location
+        courier_icon=package.courier_icon,
+        found=package.found,
+        delivered=package.delivered,
+        last_location=last_location,
+        locations=locations
     )
 
+def location_hash(location: models.Location) -> str:
+    # Identifies a tracking event by its content, the tracker doesn't give them ids
+    content = "\x1f".join((str(location.location), str(location.description), str(location.datetime)))
+    return hashlib.blake2b(content.encode(), digest_size=16).hexdigest()
+
+def _cache_result(courier: str, id: str, result: models.TrackingResult, failed: bool = False):
+    if failed:
+        ttl = TRACKER_CACHE_ERROR_TTL
+    elif not result.found:
+        ttl = TRACKER_CACHE_NOT_FOUND_TTL
+    else:
+        ttl = None
+
+    results_cache.put((courier, id), result, ttl)
+
+async def _lookup_package_info(logger: logging.Logger, courier: str, id: str) -> models.TrackingResult:
+    try:
+        status, body = await tracker.fetch_json(logger, courier, f"/track-one/{courier}/{id}")
+    except tracker.TRACKER_ERRORS as e:
+        logger.debug("Request for %s (%s) failed: %r", id, courier, e)
+        _cache_result(courier, id, None, failed=True)
+        return None
+    
+    if body is None:
+        logger.debug("Request failed with status code %s", status)
+        _cache_result(courier, id, None, failed=True)
+        return None
+
+    if body.data is None or id not in body.data:
+        logger.debug("Response for %s (%s) doesn't include it", id, courier)
+        _cache_result(courier, id, None, failed=True)
+        return None
+
+    try:
+        result = parse_package(id, body.data[id])
+    except msgspec.ValidationError as e:
+        logger.debug("Malformed response for %s (%s): %r", id, courier, e)
+        _cache_result(courier, id, None, failed=True)
+        return None
+
+    _cache_result(courier, id, result)
+    return result
+
+async def _coalesce(courier: str, ids: List[str], lookup) -> Dict[str, models.TrackingResult]:
+    # Single flight: ids that are already being looked up wait for that lookup instead of sending
+    # another request, and lookup(missing) is started once for the rest. The lookup runs in its own task
+    # so a caller that gets cancelled doesn't cancel it for everyone else, and its result or exception
+    # reaches every caller waiting on it. It's only cancelled once nobody is waiting for it anymore.
+    tasks = {}
+    missing = []
+    for id in ids:
+        task = _in_flight.get((courier, id))
+        if task is None:
+            missing.append(id)
+        else:
+            tasks[id] = task
+
+    if missing:
+        task = asyncio.ensure_future(lookup(missing))
+
+        def done(task: asyncio.Task, keys=[(courier, id) for id in missing]):
+            for key in keys:
+                if _in_flight.get(key) is task:
+                    del _in_flight[key]
+
+        task.add_done_callback(done)
+        for id in missing:
+            _in_flight[(courier, id)] = task
+            tasks[id] = task
+
+    waiting = set(tasks.values())
+    for task in waiting:
+        _waiters[task] += 1
+
+    try:
+        return { id: (await asyncio.shield(task))[id] for id, task in tasks.items() }
+    finally:
+        for task in waiting:
+            _waiters[task] -= 1
+            if _waiters[task] == 0:
+                del _waiters[task]
+                if not task.done():
+                    # Forgotten first, so a caller arriving while it's being cancelled starts a new lookup
+                    # instead of joining this one and getting its CancelledError
+                    for key in [key for key, in_flight in _in_flight.items() if in_flight is task]:
+                        del _in_flight[key]
+                    task.cancel()
+
+async def retrieve_package_info(logger: logging.Logger, courier: str, id: str, max_age: float = None) -> models.TrackingResult:
+    # A cached result is returned if it's younger than max_age (and its own ttl).
+    # Commands are fine with a slightly stale answer, max_age=0 always asks the tracker.
+    hit, result = results_cache.get((courier, id), max_age)
+    if hit:
+        logger.debug("Cache hit for %s (%s)", id, courier)
+        return result
+
+    async def lookup(ids: List[str]):
+        return { id: await _lookup_package_info(logger, courier, id) }
+
+    return (await _coalesce(courier, [id], lookup))[id]
+
+async def detect_courier(logger: logging.Logger, id: str):
+    # Finds the courier of an id: (courier, package), or (None, None) if no courier knows it.
+    # The couriers the id's format fits are asked at the same time, the first one to find it wins
+    # and the other lookups are cancelled. If none of them finds it, the rest are asked the same way.
+    hit, courier = detection_cache.get(id)
+    if hit:
+        package = await retrieve_package_info(logger, courier, id)
+        if package is not None and package.found:
+            return courier, package
+        detection_cache.discard(id)
+
+    unavailable = None
+    for candidates in candidate_couriers(id):
+        logger.debug("Detecting the courier of %s, candidates: %s", id, candidates)
+        try:
+            courier, package = await _probe_couriers(logger, id, candidates)
+        except tracker.CourierUnavailable as e:
+            unavailable = e
+            continue
+
+        if courier is not None:
+            detection_cache.put(id, courier)
+            return courier, package
+
+    # Nobody found it, but a courier that could have didn't answer
+    if unavailable is not None:
+        raise unavailable
+
+    return None, None
+
+async def _probe_couriers(logger: logging.Logger, id: str, candidates: List[str]):
+    # Asks every candidate at once: (courier, package) of the first to find it, or (None, None).
+    # Raises CourierUnavailable if nobody found it and one of them didn't answer.
+    probes = { asyncio.ensure_future(retrieve_package_info(logger, courier, id)): courier for courier in candidates }
+    unavailable = None
+    try:
+        pending = set(probes)
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for probe in done:
+                try:
+                    package = probe.result()
+                except tracker.CourierUnavailable as e:
+                    unavailable = e
+                    continue
+                except Exception:
+                    logger.exception("Failed to look up %s (%s)", id, probes[probe])
+                    continue
+
+                if package is not None and package.found:
+                    return probes[probe], package
+    finally:
+        for probe in probes:
+            probe.cancel()
+
+    if unavailable is not None:
+        raise unavailable
+
+    return None, None
+
+async def retrieve_packages_info(logger: logging.Logger, courier: str, ids: List[str]) -> Dict[str, models.TrackingResult]:
+    # Looks up several ids of the same courier. This never reads from the cache,
+    # but the results are stored in it for the commands to use.
+    return await _coalesce(courier, ids, lambda missing: _lookup_packages_info(logger, courier, missing))
+
+async def _lookup_packages_info(logger: logging.Logger, courier: str, ids: List[str]) -> Dict[str, models.TrackingResult]:
+    # Looks up several ids of the same courier with a single track-many request.
+    # Ids missing from the batch response are retried one by one with track-one, and so is every id
+    # of a courier the tracker doesn't support batching for.
+    results = {}
+
+    if not _batch_unsupported.get(courier)[0] and len(ids) > 1:
+        try:
+            status, body = await tracker.fetch_json(logger, courier, f"/track-many/{courier}", params={"ids": ",".join(ids)})
+        except tracker.TRACKER_ERRORS as e:
+            logger.debug("Batch request for %s ids (%s) failed: %r", len(ids), courier, e)
+            for id in ids:
+                _cache_result(courier, id, None, failed=True)
+            return { id: None for id in ids }
+
+        if status in (404, 405, 501) or (body is not None and body.data is None):
+            logger.info("Tracker doesn't support batch requests for %s, falling back to track-one for %.0fs", courier, TRACKER_BATCH_RETRY)
+            _batch_unsupported.put(courier, True)
+        elif body is None:
+            logger.debug("Batch request failed with status code %s", status)
+            for id in ids:
+                _cache_result(courier, id, None, failed=True)
+            return { id: None for id in ids }
+        else:
+            for id in ids:
+                package = body.data.get(id)
+                if package is None:
+                    continue
+                try:
+                    results[id] = parse_package(id, package)
+                except msgspec.ValidationError as e:
+                    logger.debug("Malformed batch entry for %s (%s): %r", id, courier, e)
+                    continue
+                _cache_result(courier, id, results[id])
+
+    for id in ids:
+        if id not in results:
+            results[id] = await _lookup_package_info(logger, courier, id)
+
+    return results
+
+TRACK_MAX_IDS = int(getenv("TRACK_MAX_IDS", "25"))
+TRACK_CONCURRENCY = int(getenv("TRACK_CONCURRENCY", "4"))
+# The /track message is edited at most this often while lookups finish (message edits are rate limited)
+TRACK_UPDATE_INTERVAL = float(getenv("TRACK_UPDATE_INTERVAL", "1"))
+
+def parse_ids(text: str) -> List[str]:
+    # Ids separated by commas, semicolons or whitespace, without duplicates
+    return list(dict.fromkeys(id for id in re.split(r"[\s,;]+", text) if id))
+
+async def _track_embed(logger: logging.Logger, courier: str, id: str, history: bool) -> discord.Embed:
+    # Always returns an embed, the interaction was deferred and has to be answered even if the lookup fails
+    try:
+        return await _lookup_embed(logger, courier, id, history)
+    except Exception:
+        logger.exception("Failed to track %s (%s)", id, courier)
+        return discord.Embed(title=id, description="Failed to retrieve package info, please try again.", color=0xFFFFFF)
+
+async def _lookup_embed(logger: logging.Logger, courier: str, id: str, history: bool) -> discord.Embed:
+    try:
+        if courier is None:
+            courier, package = await detect_courier(logger, id)
+            if courier is None:
+                return discord.Embed(title=id, description="Not found with any courier.", color=0xFFFFFF)
+        else:
+            package = await retrieve_package_info(logger, courier, id)
+    except tracker.CourierUnavailable as e:
+        return discord.Embed(title=id, description=f"{e.courier} is currently unavailable, please try again later.", color=0xFFFFFF)
+
+    if package is None:
+        return discord.Embed(title=id, description="Failed to retrieve package info, please try again.", color=0xFFFFFF)
+    if not package.found:
+        return discord.Embed(title=id, description="Not found.", color=0xFFFFFF)
+
+    events = [event for event in package.locations if event != package.last_location] if history else None
+    return status_embed(package, courier, events=events)
+
+async def track_packages(logger: logging.Logger, ctx: discord.ApplicationContext, ids: List[str], courier: str = None, history: bool = False):
+    # One page per id, in the order they were given. The paginator is sent right away with a placeholder
+    # for every id, and each page is filled in as its lookup finishes.
+    embeds = [discord.Embed(title=id, description="Looking up...", color=0xFFFFFF) for id in ids]
+    paginator = pages.Paginator(pages=list(embeds))
+    await paginator.respond(ctx.interaction, ephemeral=False)
+
+    limit = asyncio.Semaphore(TRACK_CONCURRENCY)
+    changed = asyncio.Event()
+    remaining = len(ids)
+
+    async def lookup(i: int, id: str):
+        nonlocal remaining
+        async with limit:
+            embeds[i] = await _track_embed(logger, courier, id, history)
+        remaining -= 1
+        changed.set()
+
+    lookups = [asyncio.ensure_future(lookup(i, id)) for i, id in enumerate(ids)]
+    try:
+        # Every change is shown, lookups that finish while the message was just edited are picked up by the next edit
+        while True:
+            await changed.wait()
+            changed.clear()
+            finished = remaining == 0
+
+            await paginator.update(pages=list(embeds), current_page=paginator.current_page)
+            if finished:
+                break
+            await asyncio.sleep(TRACK_UPDATE_INTERVAL)
+    except discord.HTTPException as e:
+        # The message is gone, nobody's looking anymore
+        logger.debug("Stopped updating /track results: %r", e)
+    finally:
+        for task in lookups:
+            task.cancel()
+
 async def store_package(logger: logging.Logger, ctx: discord.ApplicationContext, courier: str, id: str, description: str):
-    res = await retrieve_package_info(logger, courier, id)
+    # Without a courier it's detected from the id
+    try:
+        if courier is None:
+            courier, res = await detect_courier(logger, id)
+        else:
+            res = await retrieve_package_info(logger, courier, id)
+    except tracker.CourierUnavailable as e:
+        await ctx.respond(f"{e.courier} is currently unavailable, please try again later.")
+        return
+
+    if res is None:
+        await ctx.respond(f"Failed to look up package ({id}), please try again.")
+        return
 
     if not res.found:
         await ctx.respond(f"Package ({id}) not found.")
@@ -107,37 +454,202 @@ async def store_package(logger: logging.Logger, ctx: discord.ApplicationContext,
     p = models.Package(
         tracking_id=id,
         courier_name=courier,
-        last_location=json.dumps(res.last_location.__dict__),
+        last_location=res.last_location,
         description=description
     )
 
-    sqlite3_handler.insert_package(logger, str(ctx.guild.id), p)
+    if not await sqlite3_handler.insert_package(logger, str(ctx.guild.id), p):
+        await ctx.respond(f"Package ({id}) is already being tracked.")
+        return
+
     await ctx.respond(f"Added package {id} ({description})")
 
-async def remove_package(logger: logging.Logger, ctx: discord.ApplicationContext, id: str):
-    sqlite3_handler.delete_package(logger, str(ctx.guild.id), id)
-    await ctx.respond(f"Removed package ({id})")
+BULK_ADD_MAX_ROWS = int(getenv("BULK_ADD_MAX_ROWS", "200"))
+BULK_ADD_MAX_FILE_SIZE = int(getenv("BULK_ADD_MAX_FILE_SIZE", str(256 * 1024)))
+BULK_ADD_CONCURRENCY = int(getenv("BULK_ADD_CONCURRENCY", "4"))
+BULK_ADD_BATCH_SIZE = 25
+
+# Discord's limit for the value of an embed field
+EMBED_FIELD_LIMIT = 1024
+
+def parse_bulk_rows(text: str):
+    # Rows of courier,id[,description] in csv, one per line. Returns (rows, invalid), invalid holds
+    # the rows that can't be added.
+    rows = []
+    invalid = []
+
+    lines = [line.strip() for line in text.splitlines()]
+    for fields in csv.reader(line for line in lines if line):
+        fields = [field.strip() for field in fields]
+        courier = fields[0].lower()
+        if courier == "courier":
+            # Header row
+            continue
+
+        if len(fields) < 2 or not fields[1] or courier not in courier_urls:
+            invalid.append(",".join(fields))
+            continue
+
+        id = fields[1]
+        description = ",".join(fields[2:]).strip() or id
+        rows.append((courier, id, description))
+
+    return rows, invalid
+
+def _id_list(ids: List[str]) -> str:
+    # As many ids as fit in an embed field
+    text = ""
+    for i, id in enumerate(ids):
+        more = f" and {len(ids) - i} more"
+        entry = id if i == 0 else f", {id}"
+        if len(text) + len(entry) + len(more) > EMBED_FIELD_LIMIT:
+            return text + more
+        text += entry
+    return text
+
+async def bulk_store_packages(logger: logging.Logger, ctx: discord.ApplicationContext, text: str):
+    rows, invalid = parse_bulk_rows(text)
+    if len(rows) > BULK_ADD_MAX_ROWS:
+        await ctx.respond(f"Too many packages, at most {BULK_ADD_MAX_ROWS} can be added at once.")
+        return
 
-async def edit_package(logger: logging.Logger, ctx: discord.ApplicationContext, id: str, description: str):
-    sqlite3_handler.update_package_description(logger, str(ctx.guild.id), id, description)
-    await ctx.respond(f"Edited package ({id})")
+    if len(rows) == 0:
+        await ctx.respond("No packages found. Use one `courier,id,description` row per package.")
+        return
 
-async def list_packages(logger: logging.Logger, ctx: discord.ApplicationContext):
-    packages = []
+    packages = {}
+    duplicates = []
+    for courier, id, description in rows:
+        if (courier, id) in packages:
+            duplicates.append(id)
+        else:
+            packages[(courier, id)] = description
+
+    # Every courier's ids are looked up in batches, a few batches at a time
+    by_courier = defaultdict(list)
+    for courier, id in packages:
+        by_courier[courier].append(id)
+
+    limit = asyncio.Semaphore(BULK_ADD_CONCURRENCY)
+    results = {}
+    unavailable = []
+
+    async def check(courier: str, ids: List[str]):
+        async with limit:
+            try:
+                found = await retrieve_packages_info(logger, courier, ids)
+            except tracker.CourierUnavailable:
+                unavailable.extend(ids)
+                return
+
+        for id in ids:
+            results[(courier, id)] = found.get(id)
+
+    await asyncio.gather(*(
+        check(courier, ids[i:i + BULK_ADD_BATCH_SIZE])
+        for courier, ids in by_courier.items()
+        for i in range(0, len(ids), BULK_ADD_BATCH_SIZE)
+    ))
+
+    to_add = []
+    delivered = []
+    not_found = []
+    failed = []
+    for (courier, id), description in packages.items():
+        if (courier, id) not in results:
+            continue
+
+        res = results[(courier, id)]
+        if res is None:
+            failed.append(id)
+        elif not res.found:
+            not_found.append(id)
+        elif res.delivered:
+            delivered.append(id)
+        else:
+            to_add.append(models.Package(tracking_id=id, courier_name=courier, last_location=res.last_location, description=description))
+
+    added = []
+    if to_add:
+        for package, was_added in zip(to_add, await sqlite3_handler.insert_packages(logger, str(ctx.guild.id), to_add)):
+            if was_added:
+                added.append(package.tracking_id)
+            else:
+                duplicates.append(package.tracking_id)
+
+    logger.info("Bulk add for guild %s: %s added, %s delivered, %s not found, %s failed, %s duplicates", ctx.guild.id, len(added), len(delivered), len(not_found), len(failed), len(duplicates))
 
-    tracking_ids = sqlite3_handler.get_tracking_ids_for_guild_id(logger, ctx.guild.id)
-    if len(tracking_ids) == 0:
-        await ctx.respond("No packages found.")
-        return
-    
+    embed = discord.Embed(
+        title="Bulk add",
+        description=f"Added {len(added)} of {len(rows) + len(invalid)} packages.",
+        color=0xFFFFFF
+    )
 
-    for tracking_id in tracking_ids:
-        courier_name = sqlite3_handler.get_courier_name_for_tracking_id(logger, tracking_id)
-        l = sqlite3_handler.get_last_location_for_tracking_id(logger, tracking_id)
+    for name, ids in (
+        ("Added", added),
+        ("Already delivered", delivered),
+        ("Not found", not_found),
+        ("Lookup failed, try again", failed),
+        ("Duplicates", duplicates),
+        ("Courier unavailable, try again later", unavailable),
+        ("Invalid rows", invalid),
+    ):
+        if ids:
+            embed.add_field(name=f"{name} ({len(ids)})", value=_id_list(ids), inline=False)
 
-        last_location = models.Location(**json.loads(l))
+    await ctx.respond(embed=embed)
 
-        description = sqlite3_handler.get_description_for_tracking_id(logger, str(ctx.guild.id), tracking_id)
+async def remove_package(logger: logging.Logger, ctx: discord.ApplicationContext, id: str):
+    if not await sqlite3_handler.delete_package(logger, str(ctx.guild.id), id):
+        await ctx.respond(f"You aren't tracking a package with id {id}")
+        return
+    await ctx.respond(f"Removed package ({id})")
+
+async def edit_package(logger: logging.Logger, ctx: discord.ApplicationContext, id: str, description: str):
+    if not await sqlite3_handler.update_package_description(logger, str(ctx.guild.id), id, description):
+        await ctx.respond(f"You aren't tracking a package with id {id}")
+        return
+    await ctx.respond(f"Edited package ({id})")
+
+# Discord shows at most 25 suggestions, with names and values up to 100 characters
+AUTOCOMPLETE_LIMIT = 25
+AUTOCOMPLETE_NAME_LIMIT = 100
+
+async def autocomplete_packages(ctx: discord.AutocompleteContext) -> List[discord.OptionChoice]:
+    # The guild's packages whose id, or a word of whose description, starts with what was typed so far.
+    # Answered from memory, Discord only waits 3 seconds for the suggestions. Only the last of several
+    # ids (for /track) is completed, the ones before it are kept.
+    if ctx.interaction.guild_id is None:
+        return []
+
+    typed, prefix = re.match(r"(.*?)([^\s,;]*)$", ctx.value or "", re.DOTALL).groups()
+    already_typed = set(parse_ids(typed))
+    packages = sqlite3_handler.search_packages(str(ctx.interaction.guild_id), prefix, AUTOCOMPLETE_LIMIT + len(already_typed))
+    return [
+        discord.OptionChoice(name=f"{tracking_id} - {description}"[:AUTOCOMPLETE_NAME_LIMIT] if description else tracking_id, value=typed + tracking_id)
+        for tracking_id, description in packages
+        if tracking_id not in already_typed and len(typed + tracking_id) <= AUTOCOMPLETE_NAME_LIMIT
+    ][:AUTOCOMPLETE_LIMIT]
+
+class PackagePages(Sequence):
+    # Page source for the /list paginator. Holds the raw rows and only builds the embed
+    # of a page when the paginator asks for it, so big guilds don't pay for pages nobody opens.
+    def __init__(self, rows: list):
+        self.rows = rows
+        self.embeds = {}
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, index: int) -> discord.Embed:
+        if index not in self.embeds:
+            self.embeds[index] = self.render(self.rows[index])
+        return self.embeds[index]
+
+    @staticmethod
+    def render(row: tuple) -> discord.Embed:
+        tracking_id, courier_name, description, location, location_description, last_update = row
+        last_location = models.Location(location=location, description=location_description, datetime=last_update)
 
         embed = discord.Embed(
             title=description,
@@ -150,11 +662,15 @@ async def list_packages(logger: logging.Logger, ctx: discord.ApplicationContext)
         date = parser.isoparse(last_location.datetime)
         embed.add_field(name="Date", value=date.strftime("%d-%m-%Y, %H:%M"), inline=False)
 
-        packages.append(
-            embed
-        )
+        return embed
 
-    paginator = pages.Paginator(pages=packages)
+async def list_packages(logger: logging.Logger, ctx: discord.ApplicationContext, courier: str = None, sort: str = "added"):
+    rows = await sqlite3_handler.get_packages_for_guild_id(logger, str(ctx.guild.id), courier, sort)
+    if len(rows) == 0:
+        await ctx.respond("No packages found.")
+        return
+
+    paginator = pages.Paginator(pages=PackagePages(rows))
 
     paginator.add_button(
         pages.PaginatorButton(
@@ -170,60 +686,20 @@ async def list_packages(logger: logging.Logger, ctx: discord.ApplicationContext)
 
     await paginator.respond(ctx.interaction, ephemeral=False)
 
-def check_guilds(logger: logging.Logger, bot: discord.Bot):
-    conn = sqlite3.connect("/data/data.sqlite3")
-
-    cur = conn.cursor()
-
-    cur.execute("SELECT guild_id FROM Guilds")
-    db_guild_ids = [ str(guild_id[0]) for guild_id in cur.fetchall() ]
-
-    logger.debug(f"Guilds in database: {db_guild_ids}")
-
-    conn.close()
-
-    bot_guild_ids = [ str(guild.id) for guild in bot.guilds ]
-
-    logger.debug(f"Guilds the bot has joined: {bot_guild_ids}")
-
-    for guild_id in bot_guild_ids:
-        if guild_id not in db_guild_ids:
-            logger.info(f"Adding guild {guild_id}")
-            sqlite3_handler.insert_guild(logger, str(guild_id))
-
-def create_database(logger: logging.Logger):
-    conn = sqlite3.connect("/data/data.sqlite3")
-    cur = conn.cursor()
-
-    query = """
-    ATTACH DATABASE 'data.sqlite3' AS GuildData;
-
-    CREATE TABLE IF NOT EXISTS Packages (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        tracking_id TEXT,
-        courier_name TEXT,
-        description TEXT,
-        last_location TEXT,
-        guild_id TEXT,
-        FOREIGN KEY (guild_id) REFERENCES Guilds(guild_id)
-    );
+async def check_guilds(logger: logging.Logger, bot: discord.Bot):
+    # Adds the guilds the bot joined and removes the ones it left while it was offline
+    bot_guild_ids = { str(guild.id) for guild in bot.guilds }
 
-    CREATE TABLE IF NOT EXISTS Guilds (
-        guild_id TEXT PRIMARY KEY,
-        updates_channel TEXT
-    );
-    """
+    # No guilds at all most likely means Discord didn't send them, not that the bot was removed from every guild
+    remove = len(bot_guild_ids) > 0
+    if not remove:
+        logger.warning("The bot isn't in any guilds, not removing any guilds from the database")
 
-    logger.debug(query)
+    added, removed, orphans = await sqlite3_handler.sync_guilds(logger, bot_guild_ids, remove)
 
-    cur.executescript(query)
-    conn.commit()
-    conn.close()
-   
-    logger.info("Created database.")
+    logger.info("Guilds: %s in total, %s added, %s removed, %s orphaned shipments removed", len(bot_guild_ids), len(added), len(removed), orphans)
+    logger.debug("Added guilds: %s, removed guilds: %s", added, removed)
 
 def check_database(logger: logging.Logger):
-    if not exists("/data/data.sqlite3"):
-        with open("/data/data.sqlite3", "w") as file:
-            pass
-        create_database(logger)
+    # Creates the database if it doesn't exist yet and upgrades its schema to the latest version
+    migrations.migrate(logger, sqlite3_handler.get_connection())
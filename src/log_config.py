@@ -1,5 +1,29 @@
+import atexit, json, logging
 from pydantic import BaseModel
 from os import getenv
+from queue import Queue
+from logging.config import dictConfig
+from logging.handlers import QueueHandler, QueueListener
+
+class JsonFormatter(logging.Formatter):
+    # One compact json object per line
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": self.formatTime(record, self.datefmt),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, separators=(",", ":"))
+
+class _QueueHandler(QueueHandler):
+    # Queues the record as is. QueueHandler.prepare formats the message and traceback on the calling thread
+    # and drops exc_info, this leaves both to the listener's thread (and JsonFormatter its exception field).
+    # So the arguments of a log call shouldn't be changed after it.
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
 
 class LogConfig(BaseModel):
 
@@ -7,6 +31,7 @@ class LogConfig(BaseModel):
     LOG_FORMAT: str = "%(asctime)s | %(message)s"
     LOG_LEVEL: str = getenv("LOG_LEVEL", "INFO").upper()
     LOG_PATH: str = getenv("LOG_PATH", "/logs")
+    LOG_STYLE: str = getenv("LOG_STYLE", "text").lower()   # "text" or "json"
 
     version: int = 1
     disable_existing_loggers: bool = False
@@ -15,6 +40,9 @@ class LogConfig(BaseModel):
             "()": "logging.Formatter",
             "fmt": LOG_FORMAT,
             "datefmt": "%Y-%m-%d %H:%M:%S",
+        } if LOG_STYLE != "json" else {
+            "()": JsonFormatter,
+            "datefmt": "%Y-%m-%dT%H:%M:%S",
         },
     }
     handlers: dict = {
@@ -34,4 +62,26 @@ class LogConfig(BaseModel):
     }
     loggers: dict = {
         LOGGER_NAME: {"handlers": ["default", "file"], "level": LOG_LEVEL},
-    }
\ No newline at end of file
+    }
+
+def setup_logging(config: dict) -> QueueListener:
+    # Applies the config, then moves the configured handlers to a background thread. The loggers
+    # only put records on a queue, so writing (and rotating) the log files never blocks the event loop.
+    dictConfig(config)
+
+    queue = Queue()
+    handlers = []
+    for name in config["loggers"]:
+        logger = logging.getLogger(name)
+        for handler in logger.handlers[:]:
+            logger.removeHandler(handler)
+            if handler not in handlers:
+                handlers.append(handler)
+        logger.addHandler(_QueueHandler(queue))
+
+    listener = QueueListener(queue, *handlers, respect_handler_level=True)
+    listener.start()
+    # Flushes what's still queued on exit
+    atexit.register(listener.stop)
+
+    return listener
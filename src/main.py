@@ -1,13 +1,25 @@
-import discord, logging, json
+import discord, logging
 from os import getenv
-from logging.config import dictConfig
 from discord.ext import tasks
 
-import sqlite3_handler, helpers, models
-from log_config import LogConfig
+import sqlite3_handler, helpers, metrics, notifications, poller, push, scheduler, tracker
+from log_config import LogConfig, setup_logging
 
 
-bot = discord.Bot(intents=discord.Intents.all())
+class TrackerBot(discord.Bot):
+    metrics_runner = None
+    push_runner = None
+
+    async def close(self):
+        if self.metrics_runner is not None:
+            await self.metrics_runner.cleanup()
+        if self.push_runner is not None:
+            await self.push_runner.cleanup()
+        await tracker.close_session()
+        await sqlite3_handler.close()
+        await super().close()
+
+bot = TrackerBot(intents=discord.Intents.all())
 
 @bot.event
 async def on_ready():
@@ -16,13 +28,13 @@ async def on_ready():
 
 @bot.event
 async def on_guild_join(guild: discord.Guild):
-    logger.info(f"Joined guild {guild.name} ({guild.id})")
-    sqlite3_handler.insert_guild(logger, guild.id)
+    logger.info("Joined guild %s (%s)", guild.name, guild.id)
+    await sqlite3_handler.insert_guild(logger, guild.id)
 
 @bot.event
 async def on_guild_remove(guild: discord.Guild):
-    logger.info(f"Removed from guild {guild.name} ({guild.id})")
-    sqlite3_handler.delete_guild(logger, guild.id)
+    logger.info("Removed from guild %s (%s)", guild.name, guild.id)
+    await sqlite3_handler.delete_guild(logger, guild.id)
 
 @bot.command()
 async def help(ctx: discord.ApplicationContext):
@@ -39,17 +51,23 @@ async def help(ctx: discord.ApplicationContext):
     )
 
     embed.add_field(
-        name="/track <courier> <id>",
-        value="Track a package.",
+        name="/track <ids> [courier] [history]",
+        value="Track one or more packages (separate the ids with commas or spaces).",
         inline=False,
     )
 
     embed.add_field(
-        name="/add <courier> <id> <description>",
+        name="/add <id> <description> [courier]",
         value="Add a package to track.",
         inline=False,
     )
 
+    embed.add_field(
+        name="/bulkadd [packages] [file]",
+        value="Add many packages at once, one `courier,id,description` row per package (separate pasted rows with `;`).",
+        inline=False,
+    )
+
     embed.add_field(
         name="/remove <id>",
         value="Remove a package from tracking.",
@@ -63,7 +81,7 @@ async def help(ctx: discord.ApplicationContext):
     )
 
     embed.add_field(
-        name="/list",
+        name="/list [courier] [sort]",
         value="List all the packages you are tracking.",
         inline=False,
     )
@@ -75,44 +93,87 @@ async def updates(
         ctx: discord.ApplicationContext, 
         channel: discord.Option(discord.TextChannel, "The channel to send updates to.")
         ):
-    logger.info(f"Set updates channel for guild {ctx.guild.name} ({ctx.guild.id}) to {channel.name} ({channel.id})")
-    sqlite3_handler.update_channel(logger, ctx.guild.id, channel.id)
+    logger.info("Set updates channel for guild %s (%s) to %s (%s)", ctx.guild.name, ctx.guild.id, channel.name, channel.id)
+    await sqlite3_handler.update_channel(logger, ctx.guild.id, channel.id)
     await ctx.respond(f"Set updates channel to {channel.mention}")
 
 @bot.command()
 async def track(
         ctx: discord.ApplicationContext,
-        courier: discord.Option(str, choices=["acs", "couriercenter", "easymail", "skroutz", "elta", "speedex", "geniki"], description="The courier to track."),
-        id: discord.Option(str, "The tracking id."),
+        ids: discord.Option(str, "One or more tracking ids, separated by commas or spaces.", autocomplete=helpers.autocomplete_packages),
+        courier: discord.Option(str, choices=["acs", "couriercenter", "easymail", "skroutz", "elta", "speedex", "geniki"], description="The courier to track, detected from the ids if not set.", required=False, default=None),
+        history: discord.Option(bool, "Show every event, not just the latest one.", required=False, default=False),
         ):
-    package = await helpers.retrieve_package_info(logger, courier, id)
-    await helpers.send_status(logger, package, courier_name=courier, ctx=ctx)
+    # Lookups can take longer than the 3 seconds Discord waits for a response
+    await ctx.defer()
+
+    ids = helpers.parse_ids(ids)
+    if len(ids) == 0:
+        await ctx.respond("No tracking ids given.")
+        return
+    if len(ids) > helpers.TRACK_MAX_IDS:
+        await ctx.respond(f"Too many ids, at most {helpers.TRACK_MAX_IDS} can be tracked at once.")
+        return
+
+    if len(ids) == 1:
+        await helpers.send_status(logger, ids[0], courier, ctx, history)
+    else:
+        await helpers.track_packages(logger, ctx, ids, courier, history)
 
 @bot.command()
 async def add(
         ctx: discord.ApplicationContext,
-        courier: discord.Option(str, choices=["acs", "couriercenter", "easymail", "skroutz", "elta", "speedex", "geniki"], description="The courier to track."),
         id: discord.Option(str, "The tracking id."),
         description: discord.Option(str, "The description of the package."),
+        courier: discord.Option(str, choices=["acs", "couriercenter", "easymail", "skroutz", "elta", "speedex", "geniki"], description="The courier to track, detected from the id if not set.", required=False, default=None),
         ):
-    update_channel = sqlite3_handler.get_update_channels_for_guild_ids(logger, [ctx.guild.id])[0]
-    if update_channel[0] is None:
+    await ctx.defer()
+
+    if sqlite3_handler.get_update_channel(ctx.guild.id) is None:
         await ctx.respond("No updates channel set. Use `/updates <#channel>` to set one.")
         return
 
     await helpers.store_package(logger, ctx, courier, id, description)
 
+@bot.command()
+async def bulkadd(
+        ctx: discord.ApplicationContext,
+        packages: discord.Option(str, "Rows of courier,id,description separated by ;", required=False, default=None),
+        file: discord.Option(discord.Attachment, "A .csv or .txt file with a courier,id,description row per line.", required=False, default=None),
+        ):
+    if sqlite3_handler.get_update_channel(ctx.guild.id) is None:
+        await ctx.respond("No updates channel set. Use `/updates <#channel>` to set one.")
+        return
+
+    if packages is None and file is None:
+        await ctx.respond("Paste a list of packages or attach a file.")
+        return
+
+    if file is not None and file.size > helpers.BULK_ADD_MAX_FILE_SIZE:
+        await ctx.respond(f"The file is too big, at most {helpers.BULK_ADD_MAX_FILE_SIZE // 1024}KB.")
+        return
+
+    # Looking up every id can take longer than Discord waits for a response
+    await ctx.defer()
+
+    # Pasted rows are separated by ; (the option is a single line). Files are csv as is, a ; there may be in a quoted field.
+    text = (packages or "").replace(";", "\n")
+    if file is not None:
+        text += "\n" + (await file.read()).decode("utf-8-sig", errors="replace")
+
+    await helpers.bulk_store_packages(logger, ctx, text)
+
 @bot.command()
 async def remove(
         ctx: discord.ApplicationContext,
-        id: discord.Option(str, "The tracking id."),
+        id: discord.Option(str, "The tracking id.", autocomplete=helpers.autocomplete_packages),
         ):
     await helpers.remove_package(logger, ctx, id)
 
 @bot.command()
 async def edit(
         ctx: discord.ApplicationContext,
-        id: discord.Option(str, "The tracking id."),
+        id: discord.Option(str, "The tracking id.", autocomplete=helpers.autocomplete_packages),
         description: discord.Option(str, "The new description of the package."),
         ):
     await helpers.edit_package(logger, ctx, id, description)
@@ -120,64 +181,53 @@ async def edit(
 @bot.command()
 async def list(
         ctx: discord.ApplicationContext,
+        courier: discord.Option(str, choices=["acs", "couriercenter", "easymail", "skroutz", "elta", "speedex", "geniki"], description="Only list packages of this courier.", required=False, default=None),
+        sort: discord.Option(str, choices=["added", "updated", "courier"], description="How to order the packages.", required=False, default="added"),
         ):
-    await helpers.list_packages(logger, ctx)
+    await helpers.list_packages(logger, ctx, courier, sort)
 
 
-@tasks.loop(minutes=10.0)
+@tasks.loop(seconds=scheduler.SCHEDULER_SLOT)
 async def update_ids():
     logger.debug("Starting update_ids")
-
-    # Get all courier names in the database
-    courier_names = sqlite3_handler.get_distinct_courier_names(logger)
-    for courier_name in courier_names:
-        # For each courier get the ids in the database
-        ids = sqlite3_handler.get_distinct_tracking_ids_for_courier_name(logger, courier_name)
-        for id in ids:
-            logger.debug(f"Checking id {id} for courier {courier_name}")
-            # For each id get the package info
-            package = await helpers.retrieve_package_info(logger, courier_name, id)
-            if package is None:
-                continue
-            
-            try:
-                last_location = package.last_location
-            except:
-                continue
-            
-            last_stored_location = models.Location(**json.loads(sqlite3_handler.get_last_location_for_tracking_id(logger, id)))
-            logger.debug(f"last_location: {last_location}, last_stored_location: {last_stored_location}")
-            if last_location == last_stored_location:
-                continue
-
-            # Last location has changed
-
-            # Getting the update channels for the guilds that are watching this package
-            guild_ids = sqlite3_handler.get_guild_ids_for_tracking_id(logger, id)
-            update_channels = sqlite3_handler.get_update_channels_for_guild_ids(logger, guild_ids)
-            
-            # Sending the updated status to the update channels
-            for channel_id, guild_id in zip(update_channels, guild_ids):
-                await helpers.send_status(logger, package, courier_name=courier_name, guild_id=guild_id, bot=bot, channel_id=channel_id[0])
-            
-            if package.delivered:
-                for guild_id in guild_ids:
-                    sqlite3_handler.delete_package(logger, guild_id, id)
-            else:
-                sqlite3_handler.update_package_last_location(logger, id, json.dumps(last_location.__dict__))
+    await poller.run_cycle(logger)
 
 @update_ids.before_loop
 async def update_ids_before_loop():
     await bot.wait_until_ready()
-    helpers.check_guilds(logger, bot)   # Putting this here because the bot needs to be connected and ready for the check to work
+
+@tasks.loop(seconds=notifications.NOTIFY_OUTBOX_INTERVAL)
+async def send_updates():
+    await dispatcher.poll_outbox()
+
+async def collect_shipments():
+    counts = await sqlite3_handler.count_shipments_per_courier(logger)
+    metrics.shipments.clear()
+    for courier_name, count in counts.items():
+        metrics.shipments.set(count, courier=courier_name)
+
+@send_updates.before_loop
+async def send_updates_before_loop():
+    await bot.wait_until_ready()
+    dispatcher.start()
+    bot.metrics_runner = await metrics.start(logger)
+    metrics.add_collector(collect_shipments)
+    await helpers.check_guilds(logger, bot)   # Putting this here because the bot needs to be connected and ready for the check to work
+    bot.push_runner = await push.start(logger)
 
 if __name__ == "__main__":
-    dictConfig(LogConfig().model_dump())
+    setup_logging(LogConfig().model_dump())
     logger = logging.getLogger(getenv("LOG_NAME", "courier-tracking-bot"))
 
     helpers.check_database(logger)
+    sqlite3_handler.load_guild_index(logger)
+
+    dispatcher = notifications.Dispatcher(logger, bot)
 
-    update_ids.start()
+    send_updates.start()
+    # With POLLER_MODE=external the shipments are polled by separate `python -m poller` processes
+    if poller.POLLER_MODE == "embedded":
+        update_ids.start()
 
 
 key = getenv("DISCORD_KEY")
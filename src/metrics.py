@@ -0,0 +1,144 @@
+import asyncio, logging
+from os import getenv
+from aiohttp import web
+
+# Metrics in the Prometheus text format, served on http://METRICS_HOST:METRICS_PORT/metrics.
+# Off unless METRICS_PORT is set. Poller worker processes listen on METRICS_PORT + 1 + their partition.
+METRICS_PORT = getenv("METRICS_PORT")
+METRICS_HOST = getenv("METRICS_HOST", "127.0.0.1")
+METRICS_LAG_INTERVAL = float(getenv("METRICS_LAG_INTERVAL", "1"))
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+_registry = []
+_collectors = []
+
+def _number(value: float) -> str:
+    return "+Inf" if value == float("inf") else repr(float(value))
+
+def _labels(names: tuple, values: tuple) -> str:
+    if not names:
+        return ""
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels: tuple = ()):
+        self.name = name
+        self.help = help
+        self.label_names = labels
+        self.values = {} if labels else {(): 0}
+        _registry.append(self)
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(labels[name] for name in self.label_names)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        # A copy, database timings are recorded from the database thread
+        for key, value in list(self.values.items()):
+            yield f"{self.name}{_labels(self.label_names, key)} {_number(value)}"
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        self.values[tuple(labels[name] for name in self.label_names)] = value
+
+    def clear(self):
+        self.values.clear()
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.label_names = labels
+        self.buckets = tuple(buckets) + (float("inf"),)
+        self.values = {}
+        _registry.append(self)
+
+    def observe(self, value: float, **labels):
+        key = tuple(labels[name] for name in self.label_names)
+        counts, total = self.values.get(key, ([0] * len(self.buckets), 0.0))
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+        self.values[key] = (counts, total + value)
+
+    def samples(self):
+        for key, (counts, total) in list(self.values.items()):
+            for bound, count in zip(self.buckets, counts):
+                yield f"{self.name}_bucket{_labels(self.label_names + ('le',), key + (_number(bound),))} {count}"
+            yield f"{self.name}_sum{_labels(self.label_names, key)} {_number(total)}"
+            yield f"{self.name}_count{_labels(self.label_names, key)} {counts[-1]}"
+
+poll_cycle_seconds = Histogram("courier_bot_poll_cycle_seconds", "Duration of a poll cycle")
+poll_cycle_overruns = Counter("courier_bot_poll_cycle_overruns_total", "Poll cycles that took longer than the scheduler slot")
+tracker_request_seconds = Histogram("courier_bot_tracker_request_seconds", "Duration of requests to the tracker", ("courier",))
+tracker_errors = Counter("courier_bot_tracker_errors_total", "Tracker requests that failed or returned a server error", ("courier",))
+tracker_rejected = Counter("courier_bot_tracker_rejected_total", "Tracker requests not sent because the courier's circuit was open", ("courier",))
+shipments = Gauge("courier_bot_shipments", "Shipments being tracked", ("courier",))
+notifications_sent = Counter("courier_bot_notifications_sent_total", "Status updates sent to update channels")
+notifications_failed = Counter("courier_bot_notifications_failed_total", "Status updates that couldn't be sent")
+push_notifications = Counter("courier_bot_push_notifications_total", "Pushed updates received, by how they were handled", ("result",))
+sqlite_query_seconds = Histogram("courier_bot_sqlite_query_seconds", "Time spent running database functions", ("function",))
+cache_hits = Gauge("courier_bot_cache_hits", "Reads answered from an in-memory cache since startup", ("cache",))
+cache_misses = Gauge("courier_bot_cache_misses", "Reads an in-memory cache couldn't answer since startup", ("cache",))
+cache_entries = Gauge("courier_bot_cache_entries", "Entries in an in-memory cache", ("cache",))
+event_loop_lag_seconds = Histogram("courier_bot_event_loop_lag_seconds", "How late the event loop runs a scheduled callback", buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5))
+
+def add_collector(collector):
+    # collector is a coroutine function, awaited on every scrape to refresh gauges that are read from elsewhere
+    _collectors.append(collector)
+
+def render() -> str:
+    lines = []
+    for metric in _registry:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines.extend(metric.samples())
+    return "\n".join(lines) + "\n"
+
+async def _measure_lag():
+    loop = asyncio.get_running_loop()
+    while True:
+        expected = loop.time() + METRICS_LAG_INTERVAL
+        await asyncio.sleep(METRICS_LAG_INTERVAL)
+        event_loop_lag_seconds.observe(max(loop.time() - expected, 0))
+
+async def start(logger: logging.Logger, port_offset: int = 0):
+    # Returns the runner (to clean up on shutdown), or None if metrics are off
+    if METRICS_PORT is None:
+        return None
+
+    async def handle(request: web.Request):
+        for collector in _collectors:
+            try:
+                await collector()
+            except Exception:
+                logger.exception("Failed to collect metrics")
+        return web.Response(text=render(), content_type="text/plain", charset="utf-8")
+
+    async def measure_lag(app: web.Application):
+        task = asyncio.ensure_future(_measure_lag())
+        yield
+        task.cancel()
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    app.cleanup_ctx.append(measure_lag)
+
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    port = int(METRICS_PORT) + port_offset
+    await web.TCPSite(runner, METRICS_HOST, port).start()
+    logger.info("Serving metrics on http://%s:%s/metrics", METRICS_HOST, port)
+
+    return runner
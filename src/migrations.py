@@ -0,0 +1,177 @@
+import sqlite3, logging
+
+# Each entry upgrades the schema by one version, the version a database is at is kept in PRAGMA user_version.
+# Migrations that have been released must never be edited, changes go in a new entry at the end.
+MIGRATIONS = [
+    # 1: Initial schema. Databases created before versioning already have these tables.
+    """
+    CREATE TABLE IF NOT EXISTS Packages (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        tracking_id TEXT,
+        courier_name TEXT,
+        description TEXT,
+        last_location TEXT,
+        guild_id TEXT,
+        FOREIGN KEY (guild_id) REFERENCES Guilds(guild_id)
+    );
+
+    CREATE TABLE IF NOT EXISTS Guilds (
+        guild_id TEXT PRIMARY KEY,
+        updates_channel TEXT
+    );
+    """,
+
+    # 2: Indexes for the poller and /list lookups. A guild can only track an id once,
+    # so duplicates added before this constraint existed are dropped (keeping the oldest).
+    """
+    DELETE FROM Packages
+    WHERE id NOT IN (
+        SELECT MIN(id) FROM Packages
+        GROUP BY guild_id, tracking_id
+    );
+
+    CREATE UNIQUE INDEX IF NOT EXISTS Packages_guild_id_tracking_id ON Packages (guild_id, tracking_id);
+    CREATE INDEX IF NOT EXISTS Packages_tracking_id ON Packages (tracking_id);
+    CREATE INDEX IF NOT EXISTS Packages_courier_name_tracking_id ON Packages (courier_name, tracking_id);
+    """,
+
+    # 3: Packages is split into Shipments, one row per parcel with its last known location,
+    # and Subscriptions, one row per guild tracking a parcel. A shipment is removed together
+    # with its last subscription. Packages of guilds that no longer exist are dropped.
+    """
+    CREATE TABLE Shipments (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        courier_name TEXT NOT NULL,
+        tracking_id TEXT NOT NULL,
+        location TEXT,
+        description TEXT,
+        datetime TEXT,
+        delivered INTEGER NOT NULL DEFAULT 0,
+        UNIQUE (courier_name, tracking_id)
+    );
+
+    CREATE INDEX Shipments_tracking_id ON Shipments (tracking_id);
+
+    CREATE TABLE Subscriptions (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        shipment_id INTEGER NOT NULL REFERENCES Shipments(id) ON DELETE CASCADE,
+        guild_id TEXT NOT NULL REFERENCES Guilds(guild_id) ON DELETE CASCADE,
+        description TEXT,
+        UNIQUE (guild_id, shipment_id)
+    );
+
+    CREATE INDEX Subscriptions_shipment_id ON Subscriptions (shipment_id);
+
+    CREATE TRIGGER Subscriptions_delete_orphans
+    AFTER DELETE ON Subscriptions
+    WHEN NOT EXISTS (SELECT 1 FROM Subscriptions WHERE shipment_id = OLD.shipment_id)
+    BEGIN
+        DELETE FROM Shipments WHERE id = OLD.shipment_id;
+    END;
+
+    INSERT OR IGNORE INTO Shipments (courier_name, tracking_id, location, description, datetime)
+    SELECT Packages.courier_name, Packages.tracking_id,
+           json_extract(Packages.last_location, '$.location'),
+           json_extract(Packages.last_location, '$.description'),
+           json_extract(Packages.last_location, '$.datetime')
+    FROM Packages
+    JOIN Guilds ON Guilds.guild_id = Packages.guild_id
+    ORDER BY Packages.id;
+
+    INSERT OR IGNORE INTO Subscriptions (shipment_id, guild_id, description)
+    SELECT Shipments.id, Packages.guild_id, Packages.description
+    FROM Packages
+    JOIN Guilds ON Guilds.guild_id = Packages.guild_id
+    JOIN Shipments ON Shipments.courier_name = Packages.courier_name AND Shipments.tracking_id = Packages.tracking_id
+    ORDER BY Packages.id;
+
+    DROP TABLE Packages;
+    """,
+
+    # 4: Per shipment polling schedule. next_check_at is when the poller should look at a shipment next
+    # and last_change_at when its location last changed (both unix timestamps). Existing shipments
+    # are due right away, and their last change is taken from the stored location.
+    """
+    ALTER TABLE Shipments ADD COLUMN next_check_at INTEGER NOT NULL DEFAULT 0;
+    ALTER TABLE Shipments ADD COLUMN last_change_at INTEGER;
+
+    UPDATE Shipments SET last_change_at = CAST(strftime('%s', datetime) AS INTEGER);
+
+    CREATE INDEX Shipments_next_check_at ON Shipments (next_check_at) WHERE delivered = 0;
+    """,
+
+    # 5: Changes found by the poller workers, waiting for the bot to send them. One row per update channel.
+    """
+    CREATE TABLE Outbox (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        channel_id TEXT NOT NULL,
+        courier_name TEXT NOT NULL,
+        description TEXT,
+        package TEXT NOT NULL,
+        created_at INTEGER NOT NULL
+    );
+    """,
+
+    # 6: Every tracking event of a shipment, identified by a hash of its content. history_hash is the
+    # hash of the shipment's latest event, the poller only looks further when it has changed.
+    """
+    CREATE TABLE History (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        shipment_id INTEGER NOT NULL REFERENCES Shipments(id) ON DELETE CASCADE,
+        hash TEXT NOT NULL,
+        location TEXT,
+        description TEXT,
+        datetime TEXT,
+        UNIQUE (shipment_id, hash)
+    );
+
+    ALTER TABLE Shipments ADD COLUMN history_hash TEXT;
+    """,
+]
+
+def get_version(conn: sqlite3.Connection) -> int:
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+def _statements(script: str):
+    # Splits a migration into its statements (triggers contain semicolons, so a plain split won't do)
+    statement = ""
+    for line in script.splitlines(keepends=True):
+        statement += line
+        if sqlite3.complete_statement(statement):
+            yield statement.strip()
+            statement = ""
+
+    if statement.strip():
+        yield statement.strip()
+
+def migrate(logger: logging.Logger, conn: sqlite3.Connection):
+    version = get_version(conn)
+
+    if version > len(MIGRATIONS):
+        raise RuntimeError(f"Database is at schema version {version}, but this version of the bot only knows up to {len(MIGRATIONS)}")
+
+    for target, script in enumerate(MIGRATIONS[version:], start=version + 1):
+        # The bot and the poller workers may start at the same time. The write lock is taken before
+        # checking the version, so only one of them applies each migration.
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if get_version(conn) >= target:
+                conn.execute("COMMIT")
+                continue
+
+            logger.info("Migrating database to version %s", target)
+            logger.debug(script)
+
+            # The script and the version bump are applied in the same transaction,
+            # so a failed migration leaves the database at the previous version.
+            for statement in _statements(script):
+                conn.execute(statement)
+            conn.execute(f"PRAGMA user_version = {target}")
+            conn.execute("COMMIT")
+        except sqlite3.Error:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+
+    if version < len(MIGRATIONS):
+        logger.info("Database is at version %s", len(MIGRATIONS))
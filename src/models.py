@@ -1,22 +1,53 @@
-from dataclasses import dataclass
+import msgspec
+from dataclasses import dataclass, field
+from typing import Dict, List
 
-@dataclass
+@dataclass(slots=True)
 class Location:
     location: str
     description: str
     datetime: str
 
-@dataclass
+@dataclass(slots=True)
 class TrackingResult:
     id: str
     found: bool
     delivered: bool
     courier_icon: str
     last_location: Location
+    locations: List[Location] = field(default_factory=list)   # Every event, oldest first
 
-@dataclass
+@dataclass(slots=True)
 class Package:
     tracking_id: str
     courier_name: str
-    last_location: str
-    description: str
\ No newline at end of file
+    last_location: Location
+    description: str
+
+@dataclass(slots=True)
+class Shipment:
+    id: int
+    courier_name: str
+    tracking_id: str
+    last_location: Location
+    delivered: bool
+    next_check_at: int = 0
+    last_change_at: int = None
+    history_hash: str = None
+
+# The tracker's responses, as they're decoded. Fields that aren't listed here are skipped without being parsed.
+# The entries in data are left undecoded, so one malformed entry doesn't fail the whole batch.
+class TrackerResponse(msgspec.Struct):
+    data: Dict[str, msgspec.Raw] = None
+
+class TrackerPackage(msgspec.Struct):
+    found: bool
+    delivered: bool = False
+    courier_icon: str = ""
+    locations: List[Location] = []
+
+# A change pushed to the bot, see push.py
+class PushNotification(msgspec.Struct, omit_defaults=True):
+    courier: str
+    id: str
+    package: msgspec.Raw = None   # The parcel's data in the tracker's format, looked up from the tracker if missing
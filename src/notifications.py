@@ -0,0 +1,198 @@
+import discord, asyncio, logging, random, time
+from os import getenv
+from collections import defaultdict
+
+import helpers, metrics, sqlite3_handler
+
+NOTIFY_OUTBOX_INTERVAL = float(getenv("NOTIFY_OUTBOX_INTERVAL", "5"))
+NOTIFY_OUTBOX_BATCH = int(getenv("NOTIFY_OUTBOX_BATCH", "500"))
+NOTIFY_LINGER = float(getenv("NOTIFY_LINGER", "2"))
+NOTIFY_RETRIES = int(getenv("NOTIFY_RETRIES", "3"))
+NOTIFY_RETRY_BACKOFF = float(getenv("NOTIFY_RETRY_BACKOFF", "2"))
+
+# How much of the event history an update shows, so that a few updates still fit in one message
+NOTIFY_HISTORY_LIMIT = int(getenv("NOTIFY_HISTORY_LIMIT", "1000"))
+
+# Discord allows up to 10 embeds in one message, and up to 6000 characters across all of them
+EMBEDS_PER_MESSAGE = 10
+MESSAGE_EMBED_CHARACTERS = 6000
+
+# Discord's documented limits: 50 requests per second globally and 5 messages per 5 seconds per channel
+GLOBAL_RATE = (50, 1.0)
+CHANNEL_RATE = (5, 5.0)
+
+class TokenBucket:
+    def __init__(self, capacity: int, period: float):
+        self.capacity = capacity
+        self.rate = capacity / period
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+class Dispatcher:
+    # Sends the status updates the poller left in the outbox to the guilds' update channels, in the background.
+    # Updates for the same channel that arrive close together are grouped into as few messages as Discord allows,
+    # and sends are paced to stay inside Discord's rate limits.
+
+    def __init__(self, logger: logging.Logger, bot: discord.Bot):
+        self.logger = logger
+        self.bot = bot
+        self.queue = asyncio.Queue()
+        self.channels = {}
+        self.channel_locks = defaultdict(asyncio.Lock)
+        self.channel_buckets = {}
+        self.global_bucket = TokenBucket(*GLOBAL_RATE)
+        self.tasks = set()
+        self.outbox_cursor = 0
+        self.handled = []
+        self.sent = 0
+        self.failed = 0
+
+    def start(self):
+        self._spawn(self._run())
+
+    def enqueue(self, channel_id: str, embed: discord.Embed, outbox_id: int = None):
+        self.queue.put_nowait((str(channel_id), embed, outbox_id))
+
+    async def poll_outbox(self):
+        # Outbox entries are only removed once their update was sent (or given up on), so updates
+        # that were still queued when the bot stopped are sent after it restarts.
+        if self.handled:
+            handled, self.handled = self.handled, []
+            try:
+                await sqlite3_handler.delete_outbox(self.logger, handled)
+            except Exception:
+                self.logger.exception("Failed to remove %s sent updates from the outbox", len(handled))
+                self.handled.extend(handled)
+
+        while True:
+            try:
+                updates = await sqlite3_handler.get_outbox(self.logger, self.outbox_cursor, NOTIFY_OUTBOX_BATCH)
+            except Exception:
+                self.logger.exception("Failed to read the outbox")
+                return
+
+            for id, channel_id, courier_name, description, package in updates:
+                self.outbox_cursor = id
+                if package.delivered:
+                    # Removed from the database by whoever polled it, which may be another process
+                    await sqlite3_handler.forget_shipment(self.logger, courier_name, package.id)
+                try:
+                    # Lists every event since the last poll, not just the latest one
+                    events = [event for event in package.locations if event != package.last_location]
+                    self.enqueue(channel_id, helpers.status_embed(package, courier_name, description, events=events, history_limit=NOTIFY_HISTORY_LIMIT), id)
+                except Exception:
+                    self.logger.exception("Failed to queue update %s for %s (%s)", id, package.id, courier_name)
+                    self.handled.append(id)
+
+            if len(updates) < NOTIFY_OUTBOX_BATCH:
+                return
+
+    def _spawn(self, coro):
+        task = asyncio.ensure_future(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def _run(self):
+        while True:
+            channel_id, embed, outbox_id = await self.queue.get()
+
+            # Give the rest of a poll cycle's updates a moment to arrive, then take everything queued
+            await asyncio.sleep(NOTIFY_LINGER)
+
+            pending = defaultdict(list)
+            pending[channel_id].append((embed, outbox_id))
+            while not self.queue.empty():
+                channel_id, embed, outbox_id = self.queue.get_nowait()
+                pending[channel_id].append((embed, outbox_id))
+
+            for channel_id, updates in pending.items():
+                self._spawn(self._deliver(channel_id, updates))
+
+    async def _get_channel(self, channel_id: str):
+        channel = self.channels.get(channel_id)
+        if channel is None:
+            channel = self.bot.get_channel(int(channel_id))
+        if channel is None:
+            channel = await self.bot.fetch_channel(int(channel_id))
+
+        self.channels[channel_id] = channel
+        return channel
+
+    async def _deliver(self, channel_id: str, updates: list):
+        # One channel's messages go out in order, other channels are sent in parallel
+        async with self.channel_locks[channel_id]:
+            for message in self._messages(updates):
+                embeds, outbox_ids = zip(*message)
+                await self._send(channel_id, list(embeds))
+                self.handled.extend(id for id in outbox_ids if id is not None)
+
+    @staticmethod
+    def _messages(updates: list) -> list:
+        # Groups the updates into messages that stay inside both of Discord's embed limits
+        messages = []
+        length = 0
+        for embed, outbox_id in updates:
+            if not messages or len(messages[-1]) == EMBEDS_PER_MESSAGE or length + len(embed) > MESSAGE_EMBED_CHARACTERS:
+                messages.append([])
+                length = 0
+            messages[-1].append((embed, outbox_id))
+            length += len(embed)
+        return messages
+
+    async def _send(self, channel_id: str, embeds: list):
+        bucket = self.channel_buckets.get(channel_id)
+        if bucket is None:
+            bucket = self.channel_buckets[channel_id] = TokenBucket(*CHANNEL_RATE)
+
+        for attempt in range(NOTIFY_RETRIES + 1):
+            if attempt > 0:
+                await asyncio.sleep(random.uniform(0, NOTIFY_RETRY_BACKOFF * 2 ** (attempt - 1)))
+
+            await bucket.acquire()
+            await self.global_bucket.acquire()
+
+            try:
+                channel = await self._get_channel(channel_id)
+                await channel.send(embeds=embeds)
+            except (discord.NotFound, discord.Forbidden) as e:
+                # The channel is gone or the bot can't post there anymore, retrying won't help
+                self.logger.warning("Can't send updates to channel %s: %s", channel_id, e)
+                self.channels.pop(channel_id, None)
+                break
+            except discord.HTTPException as e:
+                if e.status == 429 or e.status >= 500:
+                    self.logger.debug("Sending %s updates to channel %s failed (attempt %s): %r", len(embeds), channel_id, attempt + 1, e)
+                    continue
+
+                # Discord rejected the message itself, sending it again won't change that. Each half is
+                # tried on its own so one bad update doesn't take the rest of the message with it.
+                if len(embeds) > 1:
+                    await self._send(channel_id, embeds[:len(embeds) // 2])
+                    await self._send(channel_id, embeds[len(embeds) // 2:])
+                    return
+
+                self.logger.error("Discord rejected an update for channel %s: %s", channel_id, e)
+                break
+            except (asyncio.TimeoutError, OSError) as e:
+                self.logger.debug("Sending %s updates to channel %s failed (attempt %s): %r", len(embeds), channel_id, attempt + 1, e)
+                continue
+
+            self.sent += len(embeds)
+            metrics.notifications_sent.inc(len(embeds))
+            return
+
+        self.failed += len(embeds)
+        metrics.notifications_failed.inc(len(embeds))
+        self.logger.error("Failed to send %s updates to channel %s", len(embeds), channel_id)
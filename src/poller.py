@@ -0,0 +1,241 @@
+import asyncio, logging, time, multiprocessing, signal, sys
+from os import getenv
+from collections import defaultdict
+from logging.config import dictConfig
+
+import helpers, metrics, scheduler, sqlite3_handler, tracker
+from log_config import LogConfig, setup_logging
+
+# "embedded": the bot polls on its own event loop. "external": the bot only sends the updates,
+# polling is left to worker processes started with `python -m poller`.
+POLLER_MODE = getenv("POLLER_MODE", "embedded")
+
+# Every worker polls the shipments whose id % POLLER_PARTITIONS is its partition. Without
+# POLLER_PARTITION, `python -m poller` starts one worker process per partition.
+POLLER_PARTITIONS = max(int(getenv("POLLER_PARTITIONS", "1")), 1)
+POLLER_PARTITION = getenv("POLLER_PARTITION")
+
+POLLER_CONCURRENCY = int(getenv("POLLER_CONCURRENCY", "16"))
+POLLER_COURIER_CONCURRENCY = int(getenv("POLLER_COURIER_CONCURRENCY", "4"))
+POLLER_BATCH_SIZE = max(int(getenv("POLLER_BATCH_SIZE", "25")), 1)
+POLLER_MAX_PER_SLOT = int(getenv("POLLER_MAX_PER_SLOT", "5000"))
+
+# Marks the end of the stream between two stages
+_DONE = object()
+
+async def _requeue(logger: logging.Logger, shipments: list, delay: float):
+    # The courier's circuit is open, check these again once it's expected to let requests through
+    now = time.time()
+    schedule = [(int(scheduler.retry_at(now, max(delay, scheduler.SCHEDULER_SLOT))), shipment.id) for shipment in shipments]
+    logger.debug("Requeueing %s shipments of an unavailable courier", len(shipments))
+
+    try:
+        await sqlite3_handler.reschedule_shipments(logger, schedule)
+    except Exception:
+        logger.exception("Failed to reschedule %s shipments", len(schedule))
+
+async def _fetch_courier(logger: logging.Logger, courier_name: str, chunks: list, start_times: list, global_limit: asyncio.Semaphore, diff_queue: asyncio.Queue):
+    # Each chunk is looked up with one request, no earlier than its start time so the slot's requests are
+    # spread out instead of sent in a burst. A few workers per courier pull chunks from a shared iterator,
+    # so a slow courier only ties up its own workers (and its share of the global limit).
+    loop = asyncio.get_running_loop()
+    pending = iter(zip(chunks, start_times))
+
+    async def worker():
+        for chunk, start_time in pending:
+            breaker = tracker.breakers[courier_name]
+            if breaker.state == breaker.OPEN and breaker.retry_after() > 0:
+                await _requeue(logger, chunk, breaker.retry_after())
+                continue
+
+            await asyncio.sleep(max(start_time - loop.time(), 0))
+
+            ids = [shipment.tracking_id for shipment in chunk]
+            async with global_limit:
+                logger.debug("Checking ids %s for courier %s", ids, courier_name)
+                try:
+                    packages = await helpers.retrieve_packages_info(logger, courier_name, ids)
+                except tracker.CourierUnavailable as e:
+                    await _requeue(logger, chunk, e.retry_after)
+                    continue
+                except Exception:
+                    logger.exception("Failed to retrieve %s ids (%s)", len(ids), courier_name)
+                    packages = {}
+
+            for shipment in chunk:
+                await diff_queue.put((shipment, packages.get(shipment.tracking_id)))
+
+    await asyncio.gather(*(worker() for _ in range(min(POLLER_COURIER_CONCURRENCY, len(chunks)))))
+
+async def _fetch(logger: logging.Logger, partition: int, partitions: int, diff_queue: asyncio.Queue):
+    global_limit = asyncio.Semaphore(POLLER_CONCURRENCY)
+
+    try:
+        shipments = await sqlite3_handler.get_due_shipments(logger, int(time.time()), POLLER_MAX_PER_SLOT, partition, partitions)
+        logger.debug("%s shipments are due", len(shipments))
+
+        by_courier = defaultdict(list)
+        for shipment in shipments:
+            by_courier[shipment.courier_name].append(shipment)
+
+        chunks = [
+            (courier_name, courier_shipments[i:i + POLLER_BATCH_SIZE])
+            for courier_name, courier_shipments in by_courier.items()
+            for i in range(0, len(courier_shipments), POLLER_BATCH_SIZE)
+        ]
+        start_times = scheduler.spread(len(chunks), asyncio.get_running_loop().time())
+
+        courier_chunks = defaultdict(lambda: ([], []))
+        for (courier_name, chunk), start_time in zip(chunks, start_times):
+            courier_chunks[courier_name][0].append(chunk)
+            courier_chunks[courier_name][1].append(start_time)
+
+        await asyncio.gather(*(
+            _fetch_courier(logger, courier_name, chunk_list, chunk_start_times, global_limit, diff_queue)
+            for courier_name, (chunk_list, chunk_start_times) in courier_chunks.items()
+        ))
+    finally:
+        await diff_queue.put(_DONE)
+
+async def _reschedule(logger: logging.Logger, schedule: list):
+    try:
+        await sqlite3_handler.reschedule_shipments(logger, schedule)
+    except Exception:
+        logger.exception("Failed to reschedule %s shipments", len(schedule))
+    schedule.clear()
+
+async def _diff(logger: logging.Logger, diff_queue: asyncio.Queue, persist_queue: asyncio.Queue):
+    # The hash of the shipment's latest event comes with it, so diffing doesn't touch the database and
+    # only the newest event has to be hashed. Shipments that didn't change only need their next check
+    # moved, those writes are batched.
+    schedule = []
+
+    try:
+        while (item := await diff_queue.get()) is not _DONE:
+            shipment, package = item
+            now = time.time()
+
+            if package is None or not package.found:
+                schedule.append((int(scheduler.retry_at(now)), shipment.id))
+            elif shipment.history_hash is not None and package.locations:
+                if helpers.location_hash(package.locations[-1]) == shipment.history_hash:
+                    schedule.append((int(scheduler.next_check_at(shipment, now)), shipment.id))
+                else:
+                    await persist_queue.put((shipment, package, True))
+            elif package.last_location == shipment.last_location:
+                if package.locations:
+                    # No history stored yet (the shipment was just added, or predates it), store it without notifying
+                    await persist_queue.put((shipment, package, False))
+                else:
+                    schedule.append((int(scheduler.next_check_at(shipment, now)), shipment.id))
+            else:
+                # Last location has changed
+                await persist_queue.put((shipment, package, True))
+
+            if len(schedule) >= POLLER_BATCH_SIZE:
+                await _reschedule(logger, schedule)
+    finally:
+        if schedule:
+            await _reschedule(logger, schedule)
+
+        await persist_queue.put(_DONE)
+
+async def _persist(logger: logging.Logger, persist_queue: asyncio.Queue):
+    # The new events are saved together with an outbox entry per update channel, the bot picks those up and sends them
+    while (item := await persist_queue.get()) is not _DONE:
+        shipment, package, notify = item
+        now = time.time()
+        if notify:
+            shipment.last_change_at = int(now)
+
+        events = [(helpers.location_hash(location), location) for location in package.locations]
+        try:
+            new_events = await sqlite3_handler.record_shipment_change(logger, shipment.id, shipment.courier_name, package, events, notify, int(scheduler.next_check_at(shipment, now)), shipment.last_change_at)
+            logger.debug("%s new events for %s (%s)", len(new_events), shipment.tracking_id, shipment.courier_name)
+        except Exception:
+            logger.exception("Failed to persist %s (%s)", shipment.tracking_id, shipment.courier_name)
+
+async def run_cycle(logger: logging.Logger, partition: int = 0, partitions: int = 1):
+    # Polls the shipments that are due. fetch -> diff -> persist, connected by queues so all stages run at the same time.
+    # The bounded queues apply backpressure: if the database is slow, fetching slows down too.
+    diff_queue = asyncio.Queue(maxsize=POLLER_CONCURRENCY * 4)
+    persist_queue = asyncio.Queue(maxsize=POLLER_CONCURRENCY * 4)
+    started = time.perf_counter()
+
+    try:
+        await asyncio.gather(
+            _fetch(logger, partition, partitions, diff_queue),
+            _diff(logger, diff_queue, persist_queue),
+            _persist(logger, persist_queue),
+        )
+    finally:
+        elapsed = time.perf_counter() - started
+        metrics.poll_cycle_seconds.observe(elapsed)
+        if elapsed > scheduler.SCHEDULER_SLOT:
+            metrics.poll_cycle_overruns.inc()
+            logger.warning("Poll cycle took %.1fs, longer than the %.0fs slot", elapsed, scheduler.SCHEDULER_SLOT)
+
+async def apply_updates(logger: logging.Logger, updates: list):
+    # Runs (shipment, package) pairs that didn't come from a poll cycle (pushed updates) through the same
+    # diff and persist stages, so they're stored and sent the same way
+    diff_queue = asyncio.Queue()
+    persist_queue = asyncio.Queue()
+    for update in updates:
+        diff_queue.put_nowait(update)
+    diff_queue.put_nowait(_DONE)
+
+    await asyncio.gather(
+        _diff(logger, diff_queue, persist_queue),
+        _persist(logger, persist_queue),
+    )
+
+async def run_worker(logger: logging.Logger, partition: int, partitions: int):
+    logger.info("Poller worker for partition %s/%s started", partition, partitions)
+    loop = asyncio.get_running_loop()
+    metrics_runner = await metrics.start(logger, port_offset=1 + partition)
+
+    try:
+        while True:
+            started = loop.time()
+            try:
+                await run_cycle(logger, partition, partitions)
+            except Exception:
+                logger.exception("Poll cycle failed")
+
+            await asyncio.sleep(max(scheduler.SCHEDULER_SLOT - (loop.time() - started), 0))
+    finally:
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        await tracker.close_session()
+        await sqlite3_handler.close()
+
+def _start_worker(partition: int, partitions: int):
+    log_config = LogConfig()
+    config = log_config.model_dump()
+    # Every process gets its own log file, rotating one file from several processes isn't safe
+    if partitions > 1:
+        config["handlers"]["file"]["filename"] = f"{log_config.LOG_PATH}/{log_config.LOGGER_NAME}-{partition}.log"
+    setup_logging(config)
+    logger = logging.getLogger(log_config.LOGGER_NAME)
+
+    try:
+        asyncio.run(run_worker(logger, partition, partitions))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    dictConfig(LogConfig().model_dump())
+    helpers.check_database(logging.getLogger(getenv("LOG_NAME", "courier-tracking-bot")))
+
+    if POLLER_PARTITION is not None or POLLER_PARTITIONS == 1:
+        _start_worker(int(POLLER_PARTITION or 0), POLLER_PARTITIONS)
+    else:
+        # One process per partition, so polling uses every core. The workers are stopped along with
+        # this process (docker stop sends SIGTERM, which otherwise wouldn't let multiprocessing clean up).
+        signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+        context = multiprocessing.get_context("spawn")
+        workers = [context.Process(target=_start_worker, args=(partition, POLLER_PARTITIONS), name=f"poller-{partition}", daemon=True) for partition in range(POLLER_PARTITIONS)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
@@ -0,0 +1,45 @@
+import bisect
+from typing import Iterable, List
+
+class PrefixIndex:
+    # (key, value) pairs kept sorted by key, so every key that starts with a prefix sits in one run
+    # that's found with a binary search. Keys are matched case insensitively, a value can have many keys.
+    # Changes replace the list instead of editing it, so a search running on another thread always
+    # sees a consistent list.
+
+    def __init__(self, pairs: Iterable[tuple] = ()):
+        self.entries = sorted(set((key.casefold(), value) for key, value in pairs))
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, key: str, value: str):
+        entry = (key.casefold(), value)
+        i = bisect.bisect_left(self.entries, entry)
+        if i == len(self.entries) or self.entries[i] != entry:
+            self.entries = self.entries[:i] + [entry] + self.entries[i:]
+
+    def remove(self, key: str, value: str):
+        entry = (key.casefold(), value)
+        i = bisect.bisect_left(self.entries, entry)
+        if i < len(self.entries) and self.entries[i] == entry:
+            self.entries = self.entries[:i] + self.entries[i + 1:]
+
+    def search(self, prefix: str, limit: int) -> List[str]:
+        # Up to limit distinct values with a key starting with prefix, in key order
+        prefix = prefix.casefold()
+        entries = self.entries
+        values = []
+        seen = set()
+
+        i = bisect.bisect_left(entries, (prefix,))
+        while i < len(entries) and len(values) < limit:
+            key, value = entries[i]
+            if not key.startswith(prefix):
+                break
+            if value not in seen:
+                seen.add(value)
+                values.append(value)
+            i += 1
+
+        return values
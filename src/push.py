@@ -0,0 +1,151 @@
+import argparse, hashlib, hmac, logging, msgspec, sys, time, urllib.error, urllib.request, uuid
+from os import getenv
+from aiohttp import web
+
+import cache, helpers, metrics, models, poller, sqlite3_handler, tracker
+
+# Push updates: instead of waiting for the poller to notice, a publisher POSTs a notification to
+# http://PUSH_HOST:PUSH_PORT/push when a parcel changes. Off unless PUSH_PORT (and PUSH_SECRET) is set.
+#
+# The body is a json models.PushNotification. Every request carries three headers:
+#   X-Push-Timestamp: unix time it was sent at, requests older (or newer) than PUSH_MAX_AGE are rejected
+#   X-Push-Key:       unique per notification, a key that was already handled is acknowledged but not applied again
+#   X-Push-Signature: hex HMAC-SHA256 of "<timestamp>.<key>.<body>" with PUSH_SECRET
+#
+# `python -m push <courier> <id>` sends one, for trying it out without a real publisher.
+PUSH_PORT = getenv("PUSH_PORT")
+PUSH_HOST = getenv("PUSH_HOST", "127.0.0.1")
+PUSH_SECRET = getenv("PUSH_SECRET")
+PUSH_MAX_AGE = float(getenv("PUSH_MAX_AGE", "300"))
+PUSH_MAX_KEYS = int(getenv("PUSH_MAX_KEYS", "100000"))
+
+# Keys are remembered for as long as their notification is accepted, after that the timestamp check rejects it.
+# They're only kept in memory: a notification replayed right after a restart is applied again, which only
+# rewrites the same events (the history ignores events it already has, so nothing is sent twice).
+_keys = cache.TTLCache(PUSH_MAX_KEYS, PUSH_MAX_AGE * 2)
+_decoder = msgspec.json.Decoder(models.PushNotification)
+
+def sign(secret: str, timestamp: str, key: str, body: bytes) -> str:
+    return hmac.new(secret.encode(), f"{timestamp}.{key}.".encode() + body, hashlib.sha256).hexdigest()
+
+def _response(status: int, result: str, **fields) -> web.Response:
+    metrics.push_notifications.inc(result=result)
+    return web.json_response({"result": result, **fields}, status=status)
+
+async def _apply(logger: logging.Logger, notification: models.PushNotification) -> web.Response:
+    shipment = await sqlite3_handler.get_shipment(logger, notification.courier, notification.id)
+    if shipment is None:
+        return _response(404, "unknown")
+
+    if notification.package is None:
+        try:
+            package = await helpers.retrieve_package_info(logger, notification.courier, notification.id, max_age=0)
+        except tracker.CourierUnavailable as e:
+            return _response(503, "unavailable", retry_after=round(e.retry_after))
+    else:
+        try:
+            package = helpers.parse_package(notification.id, notification.package)
+        except msgspec.ValidationError as e:
+            return _response(400, "invalid", error=str(e))
+
+    await poller.apply_updates(logger, [(shipment, package)])
+    return _response(200, "applied")
+
+async def start(logger: logging.Logger):
+    # Returns the runner (to clean up on shutdown), or None if push updates are off
+    if PUSH_PORT is None:
+        return None
+    if not PUSH_SECRET:
+        logger.error("PUSH_PORT is set but PUSH_SECRET isn't, not accepting push updates")
+        return None
+
+    async def handle(request: web.Request):
+        timestamp = request.headers.get("X-Push-Timestamp")
+        key = request.headers.get("X-Push-Key")
+        signature = request.headers.get("X-Push-Signature")
+        if not (timestamp and key and signature):
+            return _response(400, "invalid", error="Missing X-Push-Timestamp, X-Push-Key or X-Push-Signature")
+
+        body = await request.read()
+        if not hmac.compare_digest(sign(PUSH_SECRET, timestamp, key, body), signature):
+            logger.warning("Rejected a push update with a bad signature from %s", request.remote)
+            return _response(401, "forbidden")
+
+        try:
+            age = abs(time.time() - float(timestamp))
+        except ValueError:
+            return _response(400, "invalid", error="Bad X-Push-Timestamp")
+        if age > PUSH_MAX_AGE:
+            return _response(401, "expired")
+
+        hit, _ = _keys.get(key)
+        if hit:
+            return _response(200, "duplicate")
+
+        try:
+            notification = _decoder.decode(body)
+        except msgspec.DecodeError as e:
+            return _response(400, "invalid", error=str(e))
+
+        # Taken before anything is awaited, so the same notification arriving twice at once is only applied once
+        _keys.put(key, True)
+        try:
+            logger.debug("Push update for %s (%s)", notification.id, notification.courier)
+            response = await _apply(logger, notification)
+        except Exception:
+            logger.exception("Failed to apply the push update for %s (%s)", notification.id, notification.courier)
+            response = _response(500, "error")
+
+        if response.status >= 500:
+            # Let the publisher retry it
+            _keys.discard(key)
+        return response
+
+    app = web.Application()
+    app.router.add_post("/push", handle)
+
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, PUSH_HOST, int(PUSH_PORT)).start()
+    logger.info("Accepting push updates on http://%s:%s/push", PUSH_HOST, PUSH_PORT)
+
+    return runner
+
+def publish(url: str, secret: str, courier: str, id: str, package: bytes = None, key: str = None):
+    # Sends one signed notification, returns (status code, response body)
+    body = msgspec.json.encode(models.PushNotification(courier=courier, id=id, package=msgspec.Raw(package) if package else None))
+    timestamp = str(int(time.time()))
+    key = key or uuid.uuid4().hex
+
+    request = urllib.request.Request(url, data=body, method="POST", headers={
+        "Content-Type": "application/json",
+        "X-Push-Timestamp": timestamp,
+        "X-Push-Key": key,
+        "X-Push-Signature": sign(secret, timestamp, key, body),
+    })
+    try:
+        with urllib.request.urlopen(request) as res:
+            return res.status, res.read().decode()
+    except urllib.error.HTTPError as e:
+        return e.code, e.read().decode()
+
+if __name__ == "__main__":
+    # A stand-in publisher
+    parser = argparse.ArgumentParser(description="Send a push update to the bot")
+    parser.add_argument("courier")
+    parser.add_argument("id")
+    parser.add_argument("--package", help="A json file with the parcel's data in the tracker's format, the bot looks it up itself without it")
+    parser.add_argument("--key", help="The idempotency key, a random one by default")
+    parser.add_argument("--url", default=f"http://{PUSH_HOST}:{PUSH_PORT}/push")
+    args = parser.parse_args()
+
+    if not PUSH_SECRET:
+        sys.exit("PUSH_SECRET isn't set")
+
+    package = None
+    if args.package is not None:
+        with open(args.package, "rb") as f:
+            package = f.read()
+
+    status, response = publish(args.url, PUSH_SECRET, args.courier, args.id, package, args.key)
+    print(status, response)
@@ -0,0 +1,83 @@
+import random, datetime
+from os import getenv
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+import models
+
+# How often the poller wakes up to check which shipments are due. The shipments picked up
+# in one slot are spread over the slot instead of being looked up all at once.
+SCHEDULER_SLOT = float(getenv("SCHEDULER_SLOT", "60"))
+SCHEDULER_MIN_INTERVAL = float(getenv("SCHEDULER_MIN_INTERVAL", "300"))
+SCHEDULER_MAX_INTERVAL = float(getenv("SCHEDULER_MAX_INTERVAL", "10800"))
+SCHEDULER_RETRY_INTERVAL = float(getenv("SCHEDULER_RETRY_INTERVAL", "300"))
+SCHEDULER_JITTER = 0.1
+# The share of the slot the slot's requests are spread over. The rest leaves room for the last requests to
+# finish, so a cycle that runs past the slot really is behind.
+SCHEDULER_SPREAD = 0.8
+
+# With push updates on (PUSH_PORT, see push.py) changes are reported to the bot, polling is only a safety net
+# for pushes that never arrived and every shipment is checked this often instead
+SCHEDULER_SWEEP_INTERVAL = float(getenv("SCHEDULER_SWEEP_INTERVAL", "21600")) if getenv("PUSH_PORT") else None
+
+try:
+    TIMEZONE = ZoneInfo(getenv("SCHEDULER_TIMEZONE", "Europe/Athens"))
+except ZoneInfoNotFoundError:
+    TIMEZONE = datetime.timezone.utc
+
+# Hours (local time) in which couriers rarely scan parcels
+QUIET_HOURS = range(0, 7)
+
+# (time since the last change, interval) in seconds: the longer a parcel has been sitting
+# in the same place, the less often it's checked.
+MOVEMENT_INTERVALS = [
+    (60 * 60, 5 * 60),
+    (6 * 60 * 60, 15 * 60),
+    (24 * 60 * 60, 30 * 60),
+    (3 * 24 * 60 * 60, 60 * 60),
+]
+STALE_INTERVAL = 3 * 60 * 60
+
+# Couriers whose tracking data updates less often than the rest
+COURIER_INTERVAL_FACTORS = {
+    "elta": 2.0,
+}
+
+def _jitter(interval: float) -> float:
+    return interval * random.uniform(1 - SCHEDULER_JITTER, 1 + SCHEDULER_JITTER)
+
+def interval_for(shipment: models.Shipment, now: float) -> float:
+    if SCHEDULER_SWEEP_INTERVAL is not None:
+        return SCHEDULER_SWEEP_INTERVAL
+
+    if shipment.last_change_at is None:
+        since_change = 0
+    else:
+        since_change = max(now - shipment.last_change_at, 0)
+
+    interval = STALE_INTERVAL
+    for threshold, movement_interval in MOVEMENT_INTERVALS:
+        if since_change < threshold:
+            interval = movement_interval
+            break
+
+    interval *= COURIER_INTERVAL_FACTORS.get(shipment.courier_name, 1.0)
+
+    if datetime.datetime.fromtimestamp(now, TIMEZONE).hour in QUIET_HOURS:
+        interval *= 3
+
+    return min(max(interval, SCHEDULER_MIN_INTERVAL), SCHEDULER_MAX_INTERVAL)
+
+def next_check_at(shipment: models.Shipment, now: float) -> float:
+    return now + _jitter(interval_for(shipment, now))
+
+def retry_at(now: float, delay: float = SCHEDULER_RETRY_INTERVAL) -> float:
+    # For lookups that failed, so they're tried again soon without hammering the tracker
+    return now + _jitter(delay)
+
+def spread(count: int, now: float) -> list:
+    # Start times for `count` units of work, evenly spaced across the first SCHEDULER_SPREAD of the next slot with some jitter
+    if count == 0:
+        return []
+
+    step = SCHEDULER_SLOT * SCHEDULER_SPREAD / count
+    return [now + i * step + random.uniform(0, step) for i in range(count)]
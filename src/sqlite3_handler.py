@@ -1,213 +1,505 @@
-import sqlite3, logging
+import sqlite3, logging, asyncio, functools, dataclasses, msgspec, time
+
+import metrics, models
+from prefix_index import PrefixIndex
+from os import getenv
+from dateutil import parser
+from typing import Dict, List
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+DATABASE_PATH = getenv("DATABASE_PATH", "/data/data.sqlite3")
+
+# Every query runs on this one thread, so the event loop never blocks on the database and
+# the shared connection is never used by two threads at the same time.
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite3")
+_conn: sqlite3.Connection = None
+
+def get_connection() -> sqlite3.Connection:
+    global _conn
+
+    if _conn is None:
+        # The connection is kept open for the lifetime of the process. sqlite3 caches the compiled
+        # statements per connection, so the queries below are only prepared once.
+        _conn = sqlite3.connect(DATABASE_PATH, check_same_thread=False, cached_statements=256)
+        _conn.execute("PRAGMA journal_mode = WAL")
+        _conn.execute("PRAGMA synchronous = NORMAL")
+        _conn.execute("PRAGMA cache_size = -16000")
+        _conn.execute("PRAGMA temp_store = MEMORY")
+        _conn.execute("PRAGMA busy_timeout = 5000")
+        _conn.execute("PRAGMA foreign_keys = ON")
+
+    return _conn
+
+def _close_connection():
+    global _conn
+
+    if _conn is not None:
+        _conn.close()
+    _conn = None
+
+def _offload(func):
+    # Turns a blocking query function into a coroutine that runs it on the database thread
+    def timed(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            metrics.sqlite_query_seconds.observe(time.perf_counter() - started, function=func.__name__)
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(_executor, functools.partial(timed, *args, **kwargs))
+
+    return wrapper
+
+async def close():
+    await _offload(_close_connection)()
+
+# The package of an outbox entry is stored as msgpack (a blob, sqlite keeps it as is in the TEXT column),
+# smaller and faster to encode and decode than json
+_outbox_encoder = msgspec.msgpack.Encoder()
+_outbox_decoder = msgspec.msgpack.Decoder(models.TrackingResult)
+
+class _Query:
+    # A query with its parameters filled in for the debug log. Logged as a %s argument,
+    # so the string is only built when debug logging is enabled.
+    __slots__ = ("query", "params")
+
+    def __init__(self, query: str, params):
+        self.query = query
+        self.params = params
+
+    def __str__(self):
+        return self.query.replace("%", "%%").replace("?", "%s") % tuple(self.params)
+
+# In-memory copy of every guild's update channel, and of its packages' descriptions for autocompleting ids,
+# so neither needs a database query. Loaded once at startup with load_guild_index and updated by the functions
+# below that change them, once their transaction has committed. Every guild's packages are also in a
+# prefix index that autocomplete searches. Packages are keyed by (courier_name, tracking_id), a guild can
+# track the same id with more than one courier.
+_update_channels: Dict[str, str] = {}
+_descriptions: Dict[str, Dict[tuple, str]] = defaultdict(dict)
+_search: Dict[str, PrefixIndex] = {}
+
+def _index_keys(tracking_id: str, description: str) -> List[str]:
+    # A package is found by its id or by any word of its description
+    return [tracking_id, *(description or "").split()]
+
+def load_guild_index(logger: logging.Logger):
+    conn = get_connection()
+    cur = conn.cursor()
 
-import models
-from typing import List
+    guilds_query = """
+        SELECT guild_id, updates_channel FROM Guilds
+    """
 
-def get_distinct_tracking_ids_for_courier_name(logger: logging.Logger, courier_name: str):
-    conn = sqlite3.connect("/data/data.sqlite3")
+    descriptions_query = """
+        SELECT Subscriptions.guild_id, Shipments.courier_name, Shipments.tracking_id, Subscriptions.description
+        FROM Subscriptions
+        JOIN Shipments ON Shipments.id = Subscriptions.shipment_id
+    """
+
+    logger.debug("In load_guild_index executing query: %s", guilds_query)
+    _update_channels.clear()
+    for guild_id, updates_channel in cur.execute(guilds_query):
+        # Guilds that haven't set a channel have 0 (or NULL)
+        _update_channels[str(guild_id)] = None if updates_channel in (None, 0, "0") else str(updates_channel)
+
+    logger.debug("In load_guild_index executing query: %s", descriptions_query)
+    _descriptions.clear()
+    for guild_id, courier_name, tracking_id, description in cur.execute(descriptions_query):
+        _descriptions[str(guild_id)][(courier_name, tracking_id)] = description
+
+    # Built in one go, adding the packages one by one would copy the index for every one of them
+    _search.clear()
+    for guild_id, packages in _descriptions.items():
+        _search[guild_id] = PrefixIndex(
+            (key, package)
+            for package, description in packages.items()
+            for key in _index_keys(package[1], description)
+        )
+
+    logger.info("Loaded %s guilds and %s packages", len(_update_channels), sum(len(packages) for packages in _descriptions.values()))
+
+def get_update_channel(guild_id: str) -> str:
+    # None if the guild hasn't set one
+    return _update_channels.get(str(guild_id))
+
+def search_packages(guild_id: str, prefix: str, limit: int) -> List[tuple]:
+    # (tracking_id, description) of up to limit packages whose id, or a word of whose description, starts with prefix.
+    # An id tracked with more than one courier is only listed once.
+    index = _search.get(str(guild_id))
+    if index is None:
+        return []
+
+    packages = _descriptions.get(str(guild_id), {})
+    found = {}
+    for courier_name, tracking_id in index.search(prefix, limit):
+        found.setdefault(tracking_id, packages.get((courier_name, tracking_id)))
+    return list(found.items())
+
+def _couriers_of(guild_id: str, tracking_id: str) -> List[str]:
+    # The couriers the guild tracks this id with
+    return [courier_name for courier_name, id in _descriptions.get(str(guild_id), {}) if id == tracking_id]
+
+def _remember_package(guild_id: str, courier_name: str, tracking_id: str, description: str):
+    guild_id = str(guild_id)
+    _forget_package(guild_id, courier_name, tracking_id)
+
+    _descriptions[guild_id][(courier_name, tracking_id)] = description
+    index = _search.setdefault(guild_id, PrefixIndex())
+    for key in _index_keys(tracking_id, description):
+        index.add(key, (courier_name, tracking_id))
+
+def _forget_package(guild_id: str, courier_name: str, tracking_id: str):
+    guild_id = str(guild_id)
+    packages = _descriptions.get(guild_id)
+    if packages is None or (courier_name, tracking_id) not in packages:
+        return
+
+    description = packages.pop((courier_name, tracking_id))
+    index = _search.get(guild_id)
+    if index is not None:
+        for key in _index_keys(tracking_id, description):
+            index.remove(key, (courier_name, tracking_id))
+
+    if not packages:
+        _descriptions.pop(guild_id, None)
+        _search.pop(guild_id, None)
+
+def _forget_guild(guild_id: str):
+    _update_channels.pop(str(guild_id), None)
+    _descriptions.pop(str(guild_id), None)
+    _search.pop(str(guild_id), None)
+
+def _forget_shipment(courier_name: str, tracking_id: str):
+    # The shipment was delivered and removed from the database, the same id with another courier is kept
+    for guild_id in [guild_id for guild_id, packages in _descriptions.items() if (courier_name, tracking_id) in packages]:
+        _forget_package(guild_id, courier_name, tracking_id)
+
+@_offload
+def forget_shipment(logger: logging.Logger, courier_name: str, tracking_id: str):
+    # For shipments another process removed. Runs on the database thread, like every other change to the index.
+    _forget_shipment(courier_name, tracking_id)
+
+
+SHIPMENT_COLUMNS = "id, courier_name, tracking_id, location, description, datetime, delivered, next_check_at, last_change_at, history_hash"
+
+def _shipment_from_row(row: tuple) -> models.Shipment:
+    id, courier_name, tracking_id, location, description, datetime, delivered, next_check_at, last_change_at, history_hash = row
+    return models.Shipment(
+        id=id,
+        courier_name=courier_name,
+        tracking_id=tracking_id,
+        last_location=models.Location(location=location, description=description, datetime=datetime),
+        delivered=bool(delivered),
+        next_check_at=next_check_at,
+        last_change_at=last_change_at,
+        history_hash=history_hash
+    )
+
+@_offload
+def get_due_shipments(logger: logging.Logger, now: int, limit: int, partition: int = 0, partitions: int = 1) -> List[models.Shipment]:
+    # The most overdue shipments first, read straight off the Shipments_next_check_at index.
+    # Poller workers each own the shipments whose id falls in their partition.
+    conn = get_connection()
     cur = conn.cursor()
 
     query = """
-        SELECT DISTINCT tracking_id FROM Packages
-        WHERE courier_name = ?
-    """
+        SELECT {} FROM Shipments
+        WHERE delivered = 0 AND next_check_at <= ? AND id % ? = ?
+        ORDER BY next_check_at
+        LIMIT ?
+    """.format(SHIPMENT_COLUMNS)
 
-    logger.debug(f"In get_distinct_tracking_ids_for_courier_name executing query: {query.replace('?', '%s') % (courier_name,)}")
-    cur.execute(query, (courier_name,))
-    tracking_ids = [row[0] for row in cur.fetchall()]
+    logger.debug("In get_due_shipments executing query: %s", _Query(query, (now, partitions, partition, limit)))
+    cur.execute(query, (now, partitions, partition, limit))
+    shipments = [_shipment_from_row(row) for row in cur.fetchall()]
 
-    conn.close()
+    return shipments
 
-    return tracking_ids
-
-def get_distinct_courier_names(logger: logging.Logger):
-    conn = sqlite3.connect("/data/data.sqlite3")
+@_offload
+def get_shipment(logger: logging.Logger, courier_name: str, tracking_id: str) -> models.Shipment:
+    conn = get_connection()
     cur = conn.cursor()
 
     query = """
-        SELECT DISTINCT courier_name FROM Packages
-    """
+        SELECT {} FROM Shipments
+        WHERE courier_name = ? AND tracking_id = ?
+    """.format(SHIPMENT_COLUMNS)
 
-    logger.debug(f"In get_distinct_courier_names executing query: {query}")
-    cur.execute(query)
-    courier_names = [row[0] for row in cur.fetchall()]
+    logger.debug("In get_shipment executing query: %s", _Query(query, (courier_name, tracking_id)))
+    cur.execute(query, (courier_name, tracking_id))
+    row = cur.fetchone()
 
-    conn.close()
+    return None if row is None else _shipment_from_row(row)
 
-    return courier_names
-
-def get_tracking_ids_for_guild_id(logger: logging.Logger, guild_id: str):
-    conn = sqlite3.connect("/data/data.sqlite3")
+@_offload
+def count_shipments_per_courier(logger: logging.Logger):
+    conn = get_connection()
     cur = conn.cursor()
 
     query = """
-        SELECT tracking_id FROM Packages
-        WHERE guild_id = ?
+        SELECT courier_name, COUNT(*) FROM Shipments
+        GROUP BY courier_name
     """
 
-    logger.debug(f"In get_tracking_ids_for_guild_id executing query: {query.replace('?', '%s') % (guild_id,)}")
-    cur.execute(query, (guild_id,))
-    tracking_ids = [row[0] for row in cur.fetchall()]
+    logger.debug("In count_shipments_per_courier executing query: %s", query)
+    cur.execute(query)
+    counts = dict(cur.fetchall())
 
-    conn.close()
+    return counts
 
-    return tracking_ids
+# Orderings /list can ask for, mapped to their ORDER BY clause
+PACKAGE_SORT_ORDERS = {
+    "added": "Subscriptions.id",
+    "updated": "Shipments.datetime DESC, Subscriptions.id",
+    "courier": "Shipments.courier_name, Subscriptions.id",
+}
 
-def get_guild_ids_for_tracking_id(logger: logging.Logger, tracking_id: str):
-    conn = sqlite3.connect("/data/data.sqlite3")
+@_offload
+def get_packages_for_guild_id(logger: logging.Logger, guild_id: str, courier_name: str = None, sort: str = "added"):
+    conn = get_connection()
     cur = conn.cursor()
 
     query = """
-        SELECT guild_id FROM Packages
-        WHERE tracking_id = ?
-    """
+        SELECT Shipments.tracking_id, Shipments.courier_name, Subscriptions.description,
+               Shipments.location, Shipments.description, Shipments.datetime
+        FROM Subscriptions
+        JOIN Shipments ON Shipments.id = Subscriptions.shipment_id
+        WHERE Subscriptions.guild_id = ? AND (? IS NULL OR Shipments.courier_name = ?)
+        ORDER BY {}
+    """.format(PACKAGE_SORT_ORDERS[sort])
+
+    logger.debug("In get_packages_for_guild_id executing query: %s", _Query(query, (guild_id, courier_name, courier_name)))
+    cur.execute(query, (guild_id, courier_name, courier_name))
+    packages = cur.fetchall()
+
+    return packages
+
+@_offload
+def get_outbox(logger: logging.Logger, after_id: int, limit: int):
+    # Pending updates as (id, channel_id, courier_name, description, package), oldest first
+    conn = get_connection()
+    cur = conn.cursor()
 
-    logger.debug(f"In get_guild_ids_for_tracking_id executing query: {query.replace('?', '%s') % (tracking_id,)}")
-    cur.execute(query, (tracking_id,))
-    guild_ids = [row[0] for row in cur.fetchall()]
+    query = """
+        SELECT id, channel_id, courier_name, description, package FROM Outbox
+        WHERE id > ?
+        ORDER BY id
+        LIMIT ?
+    """
 
-    conn.close()
+    logger.debug("In get_outbox executing query: %s", _Query(query, (after_id, limit)))
+    cur.execute(query, (after_id, limit))
+    updates = []
+    for id, channel_id, courier_name, description, package in cur.fetchall():
+        # Entries written before the outbox switched to msgpack are json text
+        if isinstance(package, str):
+            package = msgspec.json.decode(package, type=models.TrackingResult)
+        else:
+            package = _outbox_decoder.decode(package)
+        updates.append((id, channel_id, courier_name, description, package))
 
-    return guild_ids
+    return updates
 
-def get_update_channels_for_guild_ids(logger: logging.Logger, guild_ids: List[str]):
-    conn = sqlite3.connect("/data/data.sqlite3")
+@_offload
+def insert_guild(logger: logging.Logger, guild_id: str):
+    conn = get_connection()
     cur = conn.cursor()
 
     query = """
-        SELECT updates_channel FROM Guilds
-        WHERE guild_id IN ({});
-    """.format(', '.join(['?'] * len(guild_ids)))
-
-    logger.debug(f"In get_update_channels_for_guild_ids executing query: {query.replace('?', '%s') % tuple(guild_ids)}")
-    cur.execute(query, guild_ids)
-    update_channels = cur.fetchall()
+        INSERT INTO Guilds (guild_id, updates_channel)
+        VALUES (?, 0)
+    """
 
-    conn.close()
+    logger.debug("In insert_guild executing query: %s", _Query(query, (guild_id,)))
+    with conn:
+        cur.execute(query, (guild_id,))
 
-    return update_channels
+    _update_channels[str(guild_id)] = None
 
-def get_courier_name_for_tracking_id(logger: logging.Logger, tracking_id: str) -> str :
-    conn = sqlite3.connect("/data/data.sqlite3")
+def _insert_packages(logger: logging.Logger, guild_id: str, packages: List[models.Package]) -> List[bool]:
+    conn = get_connection()
     cur = conn.cursor()
 
-    query = """
-        SELECT courier_name FROM Packages
-        WHERE tracking_id = ?
+    # If another guild already tracks this parcel the existing shipment is reused as is,
+    # the poller is the one that keeps its location up to date.
+    shipment_query = """
+        INSERT INTO Shipments (courier_name, tracking_id, location, description, datetime, last_change_at)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT (courier_name, tracking_id) DO NOTHING
     """
 
-    logger.debug(f"In get_courier_name_for_tracking_id executing query: {query.replace('?', '%s') % (tracking_id,)}")
-    cur.execute(query, (tracking_id,))
-    courier_name = cur.fetchone()[0]
+    # Ignored if the guild is already tracking this id
+    subscription_query = """
+        INSERT OR IGNORE INTO Subscriptions (shipment_id, guild_id, description)
+        SELECT id, ?, ? FROM Shipments
+        WHERE courier_name = ? AND tracking_id = ?
+    """
 
-    conn.close()
+    added = []
+    with conn:
+        for package in packages:
+            location = package.last_location
+            try:
+                last_change_at = int(parser.isoparse(location.datetime).timestamp())
+            except (ValueError, TypeError):
+                last_change_at = None
 
-    return courier_name
+            logger.debug("In insert_packages executing query: %s", _Query(shipment_query, (package.courier_name, package.tracking_id, location.location, location.description, location.datetime, last_change_at)))
+            cur.execute(shipment_query, (package.courier_name, package.tracking_id, location.location, location.description, location.datetime, last_change_at))
 
-def get_last_location_for_tracking_id(logger: logging.Logger, tracking_id: str):
-    conn = sqlite3.connect("/data/data.sqlite3")
-    cur = conn.cursor()
+            logger.debug("In insert_packages executing query: %s", _Query(subscription_query, (guild_id, package.description, package.courier_name, package.tracking_id)))
+            cur.execute(subscription_query, (guild_id, package.description, package.courier_name, package.tracking_id))
+            added.append(cur.rowcount > 0)
 
-    query = """
-        SELECT last_location FROM Packages
-        WHERE tracking_id = ?
-    """
+    for package, was_added in zip(packages, added):
+        if was_added:
+            _remember_package(guild_id, package.courier_name, package.tracking_id, package.description)
 
-    logger.debug(f"In get_last_location_for_tracking_id executing query: {query.replace('?', '%s') % (tracking_id,)}")
-    cur.execute(query, (tracking_id,))
-    last_location = cur.fetchone()[0]
+    return added
 
-    conn.close()
+@_offload
+def insert_package(logger: logging.Logger, guild_id: str, package: models.Package) -> bool:
+    # False if the guild is already tracking this id
+    return _insert_packages(logger, guild_id, [package])[0]
 
-    return last_location
+@_offload
+def insert_packages(logger: logging.Logger, guild_id: str, packages: List[models.Package]) -> List[bool]:
+    # Adds all the packages in one transaction. Returns whether each one was added
+    # (False for the ones the guild is already tracking).
+    return _insert_packages(logger, guild_id, packages)
 
-def get_description_for_tracking_id(logger: logging.Logger, guild_id: str, tracking_id: str):
-    conn = sqlite3.connect("/data/data.sqlite3")
+@_offload
+def delete_guild(logger: logging.Logger, guild_id: str):
+    conn = get_connection()
     cur = conn.cursor()
 
     query = """
-        SELECT description FROM Packages
-        WHERE tracking_id = ? AND guild_id = ?
+        DELETE FROM Guilds
+        WHERE guild_id = ?
     """
 
-    logger.debug(f"In get_description_for_tracking_id executing query: {query.replace('?', '%s') % (tracking_id, guild_id)}")
-    cur.execute(query, (tracking_id, guild_id))
-    description = cur.fetchone()
-    if description is not None:
-        description = description[0]
+    subscriptions_query = """
+        DELETE FROM Subscriptions
+        WHERE guild_id = ?
+    """
 
-    conn.close()
+    # Both deletes in one transaction, so a guild is never left half removed
+    with conn:
+        logger.debug("In delete_guild executing query: %s", _Query(subscriptions_query, (guild_id,)))
+        cur.execute(subscriptions_query, (guild_id,))
 
-    return description
+        logger.debug("In delete_guild executing query: %s", _Query(query, (guild_id,)))
+        cur.execute(query, (guild_id,))
 
-def insert_guild(logger: logging.Logger, guild_id: str):
-    conn = sqlite3.connect("/data/data.sqlite3")
+    _forget_guild(guild_id)
+
+@_offload
+def sync_guilds(logger: logging.Logger, guild_ids: List[str], remove: bool = True):
+    # Makes Guilds match the guilds the bot is in, in one transaction: missing guilds are added and (if remove)
+    # guilds the bot has left are deleted with their subscriptions. Shipments nobody subscribes to anymore are
+    # removed by the Subscriptions_delete_orphans trigger. Returns (added, removed, orphans), orphans being
+    # how many shipments the sweep below removed.
+    conn = get_connection()
     cur = conn.cursor()
 
-    query = """
+    select_query = """
+        SELECT guild_id FROM Guilds
+    """
+
+    insert_query = """
         INSERT INTO Guilds (guild_id, updates_channel)
         VALUES (?, 0)
     """
 
-    logger.debug(f"In insert_guild executing query: {query.replace('?', '%s') % (guild_id,)}")
-    cur.execute(query, (guild_id,))
-    conn.commit()
-    conn.close()
+    subscriptions_query = """
+        DELETE FROM Subscriptions
+        WHERE guild_id = ?
+    """
 
-def insert_package(logger: logging.Logger, guild_id: str, package: models.Package):
-    conn = sqlite3.connect("/data/data.sqlite3")
-    cur = conn.cursor()
+    delete_query = """
+        DELETE FROM Guilds
+        WHERE guild_id = ?
+    """
 
-    query = """
-        INSERT INTO Packages (guild_id, tracking_id, courier_name, last_location, description)
-        VALUES (?, ?, ?, ?, ?)
+    # A safety net, this should find nothing: the trigger only runs when a subscription is deleted, so it can't
+    # catch a shipment that never had one (which the bot doesn't create, but a database edited by hand may have)
+    orphans_query = """
+        DELETE FROM Shipments
+        WHERE NOT EXISTS (SELECT 1 FROM Subscriptions WHERE Subscriptions.shipment_id = Shipments.id)
     """
 
-    logger.debug(f"In insert_package executing query: {query.replace('?', '%s') % (guild_id, package.tracking_id, package.courier_name, package.last_location, package.description)}")
-    cur.execute(query, (guild_id, package.tracking_id, package.courier_name, package.last_location, package.description))
-    conn.commit()
-    conn.close()
+    guild_ids = set(guild_ids)
+    with conn:
+        logger.debug("In sync_guilds executing query: %s", select_query)
+        stored = {str(row[0]) for row in cur.execute(select_query)}
 
-def delete_guild(logger: logging.Logger, guild_id: str):
-    conn = sqlite3.connect("/data/data.sqlite3")
-    cur = conn.cursor()
+        added = sorted(guild_ids - stored)
+        removed = sorted(stored - guild_ids) if remove else []
 
-    query = """
-        DELETE FROM Guilds
-        WHERE guild_id = ?
-    """
+        logger.debug("In sync_guilds executing query for %s guilds: %s", len(added), insert_query)
+        cur.executemany(insert_query, [(guild_id,) for guild_id in added])
+
+        logger.debug("In sync_guilds executing queries for %s guilds: %s %s", len(removed), subscriptions_query, delete_query)
+        cur.executemany(subscriptions_query, [(guild_id,) for guild_id in removed])
+        cur.executemany(delete_query, [(guild_id,) for guild_id in removed])
+
+        logger.debug("In sync_guilds executing query: %s", orphans_query)
+        cur.execute(orphans_query)
+        orphans = cur.rowcount
 
-    logger.debug(f"In delete_guild executing query: {query.replace('?', '%s') % (guild_id,)}")
-    cur.execute(query, (guild_id,))
-    conn.commit()
+    for guild_id in added:
+        _update_channels[guild_id] = None
+    for guild_id in removed:
+        _forget_guild(guild_id)
+
+    return added, removed, orphans
+
+@_offload
+def delete_package(logger: logging.Logger, guild_id: str, tracking_id: str) -> bool:
+    # False if the guild isn't tracking this id. Shipments nobody subscribes to anymore are removed
+    # by the Subscriptions_delete_orphans trigger.
+    conn = get_connection()
+    cur = conn.cursor()
 
     query = """
-        DELETE FROM Packages
-        WHERE guild_id = ?
+        DELETE FROM Subscriptions
+        WHERE guild_id = ? AND shipment_id IN (
+            SELECT id FROM Shipments WHERE tracking_id = ?
+        )
     """
 
-    logger.debug(f"In delete_guild executing query: {query.replace('?', '%s') % (guild_id,)}")
-    cur.execute(query, (guild_id,))
-    conn.commit()
+    logger.debug("In delete_package executing query: %s", _Query(query, (guild_id, tracking_id)))
+    with conn:
+        cur.execute(query, (guild_id, tracking_id))
+        deleted = cur.rowcount > 0
 
-    conn.close()
+    # Every courier the guild tracks the id with was unsubscribed
+    for courier_name in _couriers_of(guild_id, tracking_id):
+        _forget_package(guild_id, courier_name, tracking_id)
+    return deleted
 
-def delete_package(logger: logging.Logger, guild_id: str, tracking_id: str):
-    conn = sqlite3.connect("/data/data.sqlite3")
+@_offload
+def delete_outbox(logger: logging.Logger, ids: List[int]):
+    conn = get_connection()
     cur = conn.cursor()
 
     query = """
-        DELETE FROM Packages
-        WHERE tracking_id = ? AND guild_id = ?
+        DELETE FROM Outbox
+        WHERE id = ?
     """
 
-    logger.debug(f"In delete_package executing query: {query.replace('?', '%s') % (tracking_id, guild_id)}")
-    cur.execute(query, (tracking_id, guild_id))
-    conn.commit()
-    conn.close()
+    logger.debug("In delete_outbox executing query for %s updates: %s", len(ids), query)
+    with conn:
+        cur.executemany(query, [(id,) for id in ids])
 
+@_offload
 def update_channel(logger: logging.Logger, guild_id: str, update_channel: str):
-    conn = sqlite3.connect("/data/data.sqlite3")
+    conn = get_connection()
     cur = conn.cursor()
 
     query = """
@@ -216,37 +508,111 @@ def update_channel(logger: logging.Logger, guild_id: str, update_channel: str):
         WHERE guild_id = ?
     """
 
-    logger.debug(f"In update_channel executing query: {query.replace('?', '%s') % (update_channel, guild_id)}")
-    cur.execute(query, (update_channel, guild_id))
-    conn.commit()
-    conn.close()
+    logger.debug("In update_channel executing query: %s", _Query(query, (update_channel, guild_id)))
+    with conn:
+        cur.execute(query, (update_channel, guild_id))
 
-def update_package_last_location(logger: logging.Logger, tracking_id: str, location: str):
-    conn = sqlite3.connect("/data/data.sqlite3")
+    if str(guild_id) in _update_channels:
+        _update_channels[str(guild_id)] = str(update_channel)
+
+@_offload
+def record_shipment_change(logger: logging.Logger, shipment_id: int, courier_name: str, package: models.TrackingResult, events: List[tuple], notify: bool, next_check_at: int, last_change_at: int):
+    # Stores the shipment's events (a list of (hash, location), oldest first) and its new status, and queues
+    # the events that weren't stored before for every guild watching it, all in one transaction. So an update
+    # is never sent for a change that wasn't saved, or the other way around.
+    # Delivered shipments are removed, along with their history and the subscriptions of every guild.
+    conn = get_connection()
+    cur = conn.cursor()
+
+    history_query = """
+        INSERT OR IGNORE INTO History (shipment_id, hash, location, description, datetime)
+        VALUES (?, ?, ?, ?, ?)
+    """
+
+    outbox_query = """
+        INSERT INTO Outbox (channel_id, courier_name, description, package, created_at)
+        SELECT Guilds.updates_channel, ?, Subscriptions.description, ?, ?
+        FROM Subscriptions
+        JOIN Guilds ON Guilds.guild_id = Subscriptions.guild_id
+        WHERE Subscriptions.shipment_id = ? AND Guilds.updates_channel IS NOT NULL AND Guilds.updates_channel != '0'
+    """
+
+    update_query = """
+        UPDATE Shipments
+        SET location = ?, description = ?, datetime = ?, delivered = ?, next_check_at = ?, last_change_at = ?, history_hash = ?
+        WHERE id = ?
+    """
+
+    delete_query = """
+        DELETE FROM Shipments
+        WHERE id = ?
+    """
+
+    location = package.last_location
+    history_hash = events[-1][0] if events else None
+
+    with conn:
+        logger.debug("In record_shipment_change executing query for %s events: %s", len(events), history_query)
+        new_events = []
+        for hash, event in events:
+            cur.execute(history_query, (shipment_id, hash, event.location, event.description, event.datetime))
+            if cur.rowcount:
+                new_events.append(event)
+
+        if notify and new_events:
+            payload = _outbox_encoder.encode(dataclasses.replace(package, locations=new_events))
+
+            logger.debug("In record_shipment_change executing query: %s", _Query(outbox_query, (courier_name, payload, last_change_at, shipment_id)))
+            cur.execute(outbox_query, (courier_name, payload, last_change_at, shipment_id))
+
+        if package.delivered:
+            logger.debug("In record_shipment_change executing query: %s", _Query(delete_query, (shipment_id,)))
+            cur.execute(delete_query, (shipment_id,))
+        else:
+            logger.debug("In record_shipment_change executing query: %s", _Query(update_query, (location.location, location.description, location.datetime, int(package.delivered), next_check_at, last_change_at, history_hash, shipment_id)))
+            cur.execute(update_query, (location.location, location.description, location.datetime, int(package.delivered), next_check_at, last_change_at, history_hash, shipment_id))
+
+    if package.delivered:
+        _forget_shipment(courier_name, package.id)
+
+    return new_events
+
+@_offload
+def reschedule_shipments(logger: logging.Logger, schedule: List[tuple]):
+    # schedule is a list of (next_check_at, shipment_id), written in one transaction
+    conn = get_connection()
     cur = conn.cursor()
 
     query = """
-        UPDATE Packages
-        SET last_location = ?
-        WHERE tracking_id = ?
+        UPDATE Shipments
+        SET next_check_at = ?
+        WHERE id = ?
     """
 
-    logger.debug(f"In update_package_last_location executing query: {query.replace('?', '%s') % (location, tracking_id)}")
-    cur.execute(query, (location, tracking_id))
-    conn.commit()
-    conn.close()
+    logger.debug("In reschedule_shipments executing query for %s shipments: %s", len(schedule), query)
+    with conn:
+        cur.executemany(query, schedule)
 
-def update_package_description(logger: logging.Logger, guild_id: str, tracking_id: str, description: str):
-    conn = sqlite3.connect("/data/data.sqlite3")
+@_offload
+def update_package_description(logger: logging.Logger, guild_id: str, tracking_id: str, description: str) -> bool:
+    # False if the guild isn't tracking this id
+    conn = get_connection()
     cur = conn.cursor()
 
     query = """
-        UPDATE Packages
+        UPDATE Subscriptions
         SET description = ?
-        WHERE tracking_id = ? AND guild_id = ?
+        WHERE guild_id = ? AND shipment_id IN (
+            SELECT id FROM Shipments WHERE tracking_id = ?
+        )
     """
 
-    logger.debug(f"In update_package_description executing query: {query.replace('?', '%s') % (description, tracking_id, guild_id)}")
-    cur.execute(query, (description, tracking_id, guild_id))
-    conn.commit()
-    conn.close()
\ No newline at end of file
+    logger.debug("In update_package_description executing query: %s", _Query(query, (description, guild_id, tracking_id)))
+    with conn:
+        cur.execute(query, (description, guild_id, tracking_id))
+        updated = cur.rowcount > 0
+
+    if updated:
+        for courier_name in _couriers_of(guild_id, tracking_id):
+            _remember_package(guild_id, courier_name, tracking_id, description)
+    return updated
@@ -0,0 +1,176 @@
+import aiohttp, asyncio, logging, msgspec, random, time
+from os import getenv
+from collections import defaultdict
+
+import metrics, models
+
+TRACKER_URL = getenv("TRACKER_URL", "https://courier-api.danielpikilidis.com")
+TRACKER_CONNECT_TIMEOUT = float(getenv("TRACKER_CONNECT_TIMEOUT", "2.5"))
+TRACKER_READ_TIMEOUT = float(getenv("TRACKER_READ_TIMEOUT", "2.5"))
+TRACKER_MAX_CONNECTIONS = int(getenv("TRACKER_MAX_CONNECTIONS", "20"))
+TRACKER_KEEPALIVE = float(getenv("TRACKER_KEEPALIVE", "60"))
+TRACKER_RETRIES = int(getenv("TRACKER_RETRIES", "2"))
+TRACKER_RETRY_BACKOFF = float(getenv("TRACKER_RETRY_BACKOFF", "0.5"))
+TRACKER_CIRCUIT_FAILURES = int(getenv("TRACKER_CIRCUIT_FAILURES", "5"))
+TRACKER_CIRCUIT_OPEN = float(getenv("TRACKER_CIRCUIT_OPEN", "30"))
+TRACKER_CIRCUIT_MAX_OPEN = float(getenv("TRACKER_CIRCUIT_MAX_OPEN", "600"))
+
+# Errors that mean the request itself failed (as opposed to the tracker answering with an error)
+TRACKER_ERRORS = (asyncio.TimeoutError, aiohttp.ClientError)
+
+_session: aiohttp.ClientSession = None
+
+def get_session() -> aiohttp.ClientSession:
+    # One session for the whole process, so connections to the tracker are kept alive and reused.
+    # Has to be created from inside the running event loop.
+    global _session
+
+    if _session is None or _session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=TRACKER_MAX_CONNECTIONS,
+            keepalive_timeout=TRACKER_KEEPALIVE,
+            ttl_dns_cache=300,
+        )
+        timeout = aiohttp.ClientTimeout(
+            sock_connect=TRACKER_CONNECT_TIMEOUT,
+            sock_read=TRACKER_READ_TIMEOUT,
+        )
+        _session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+
+    return _session
+
+async def close_session():
+    global _session
+
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
+
+_response_decoder = msgspec.json.Decoder(models.TrackerResponse)
+
+def decode_response(body: bytes) -> models.TrackerResponse:
+    # Raises msgspec.DecodeError for bodies that aren't json or don't match the schema
+    return _response_decoder.decode(body)
+
+async def get_json(logger: logging.Logger, path: str, params: dict = None):
+    # Returns (status code, models.TrackerResponse). The body is None for server errors and responses that aren't json.
+    logger.debug("Requesting data from %s%s", TRACKER_URL, path)
+
+    async with get_session().get(f"{TRACKER_URL}{path}", params=params) as res:
+        if res.status >= 500:
+            return res.status, None
+
+        try:
+            return res.status, decode_response(await res.read())
+        except msgspec.DecodeError:
+            return res.status, None
+
+class CourierUnavailable(Exception):
+    def __init__(self, courier: str, retry_after: float):
+        super().__init__(f"Courier {courier} is unavailable, retry in {retry_after:.0f}s")
+        self.courier = courier
+        self.retry_after = retry_after
+
+class CircuitBreaker:
+    # Health of one courier's upstream. After enough consecutive failures the circuit opens and
+    # requests fail fast without touching the network. Once the open period is over a single probe
+    # request is let through (half open): if it works the circuit closes, otherwise it opens again
+    # for twice as long, up to TRACKER_CIRCUIT_MAX_OPEN.
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self):
+        self.state = self.CLOSED
+        self.failures = 0
+        self.open_for = TRACKER_CIRCUIT_OPEN
+        self.open_until = 0.0
+        self.last_failure = None
+
+    def retry_after(self) -> float:
+        return max(self.open_until - time.monotonic(), 0)
+
+    def allow(self) -> bool:
+        if self.state == self.CLOSED:
+            return True
+
+        if self.state == self.OPEN and self.retry_after() == 0:
+            self.state = self.HALF_OPEN
+            return True
+
+        # Open, or half open with the probe still running
+        return False
+
+    def record_success(self):
+        self.state = self.CLOSED
+        self.failures = 0
+        self.open_for = TRACKER_CIRCUIT_OPEN
+
+    def record_failure(self):
+        self.failures += 1
+        self.last_failure = time.time()
+
+        if self.state == self.HALF_OPEN:
+            self.open_for = min(self.open_for * 2, TRACKER_CIRCUIT_MAX_OPEN)
+        elif self.failures < TRACKER_CIRCUIT_FAILURES:
+            return
+
+        self.state = self.OPEN
+        self.open_until = time.monotonic() + self.open_for * random.uniform(1, 1.2)
+
+    def release_probe(self):
+        # The probe ended without an answer (e.g. it was cancelled), let the next request probe instead
+        if self.state == self.HALF_OPEN:
+            self.state = self.OPEN
+            self.open_until = 0.0
+
+breakers = defaultdict(CircuitBreaker)
+
+async def fetch_json(logger: logging.Logger, courier: str, path: str, params: dict = None):
+    # get_json behind the courier's circuit breaker, with a few retries (exponential backoff and jitter)
+    # for timeouts and server errors. Lookups are idempotent so retrying them is safe.
+    # Raises CourierUnavailable without sending anything while the circuit is open.
+    breaker = breakers[courier]
+    if not breaker.allow():
+        metrics.tracker_rejected.inc(courier=courier)
+        raise CourierUnavailable(courier, breaker.retry_after())
+
+    # A half open circuit only gets the one probe
+    attempts = 1 if breaker.state == CircuitBreaker.HALF_OPEN else TRACKER_RETRIES + 1
+
+    for attempt in range(attempts):
+        try:
+            if attempt > 0:
+                await asyncio.sleep(random.uniform(0, TRACKER_RETRY_BACKOFF * 2 ** (attempt - 1)))
+
+            started = time.perf_counter()
+            status, body = await get_json(logger, path, params)
+        except asyncio.CancelledError:
+            breaker.release_probe()
+            raise
+        except TRACKER_ERRORS as e:
+            metrics.tracker_request_seconds.observe(time.perf_counter() - started, courier=courier)
+            metrics.tracker_errors.inc(courier=courier)
+            error = e
+            logger.debug("Request to %s failed (attempt %s/%s): %r", path, attempt + 1, attempts, e)
+        else:
+            metrics.tracker_request_seconds.observe(time.perf_counter() - started, courier=courier)
+            # 501 means the tracker doesn't implement the endpoint, retrying won't change that
+            if status < 500 or status == 501:
+                if breaker.state != CircuitBreaker.CLOSED:
+                    logger.info("Courier %s is available again", courier)
+                breaker.record_success()
+                return status, body
+
+            metrics.tracker_errors.inc(courier=courier)
+            error = None
+            logger.debug("Request to %s failed with status code %s (attempt %s/%s)", path, status, attempt + 1, attempts)
+
+    previous_state = breaker.state
+    breaker.record_failure()
+    if breaker.state == CircuitBreaker.OPEN and previous_state != CircuitBreaker.OPEN:
+        logger.warning("Courier %s is failing, pausing requests to it for %.0fs", courier, breaker.retry_after())
+
+    if error is not None:
+        raise error
+    return status, body
@@ -0,0 +1,113 @@
+import asyncio, logging, pytest
+from aiohttp import web
+
+import helpers, tracker
+
+logger = logging.getLogger("tests")
+
+def _package(location: str) -> dict:
+    return {
+        "found": True,
+        "delivered": False,
+        "courier_icon": "",
+        "locations": [{"location": location, "description": "Scan", "datetime": "2024-01-01T00:00:00"}],
+    }
+
+class StandInTracker:
+    # Serves track-one and track-many from `packages`, id -> entry (anything json, so entries can be malformed).
+    # track_many_status makes track-many answer with that status instead, and `omit` ids are left out of it.
+    def __init__(self, packages: dict, track_many_status: int = None, omit: set = ()):
+        self.packages = packages
+        self.track_many_status = track_many_status
+        self.omit = set(omit)
+        self.requests = []
+
+    async def track_one(self, request: web.Request):
+        id = request.match_info["id"]
+        self.requests.append(("one", id))
+        return web.json_response({"data": {id: self.packages[id]}})
+
+    async def track_many(self, request: web.Request):
+        ids = request.query["ids"].split(",")
+        self.requests.append(("many", ids))
+        if self.track_many_status is not None:
+            return web.Response(status=self.track_many_status)
+        return web.json_response({"data": {id: self.packages[id] for id in ids if id not in self.omit}})
+
+async def _lookup(server: StandInTracker, ids: list):
+    app = web.Application()
+    app.router.add_get("/track-one/{courier}/{id}", server.track_one)
+    app.router.add_get("/track-many/{courier}", server.track_many)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+
+    tracker.TRACKER_URL = f"http://127.0.0.1:{port}"
+    try:
+        return await helpers.retrieve_packages_info(logger, "acs", ids)
+    finally:
+        await tracker.close_session()
+        await runner.cleanup()
+
+@pytest.fixture(autouse=True)
+def reset_state():
+    helpers.results_cache.entries.clear()
+    helpers._batch_unsupported.entries.clear()
+    tracker.breakers.clear()
+
+def test_full_batch():
+    server = StandInTracker({"1": _package("A"), "2": _package("B"), "3": _package("C")})
+    results = asyncio.run(_lookup(server, ["1", "2", "3"]))
+
+    assert [results[id].last_location.location for id in ["1", "2", "3"]] == ["A", "B", "C"]
+    assert server.requests == [("many", ["1", "2", "3"])]
+
+def test_ids_missing_from_batch_use_track_one():
+    server = StandInTracker({"1": _package("A"), "2": _package("B"), "3": _package("C")}, omit={"2"})
+    results = asyncio.run(_lookup(server, ["1", "2", "3"]))
+
+    assert [results[id].last_location.location for id in ["1", "2", "3"]] == ["A", "B", "C"]
+    assert server.requests == [("many", ["1", "2", "3"]), ("one", "2")]
+
+def test_malformed_entry_only_fails_its_id():
+    server = StandInTracker({"1": _package("A"), "2": {"found": True, "locations": "broken"}, "3": _package("C")})
+    results = asyncio.run(_lookup(server, ["1", "2", "3"]))
+
+    assert results["1"].last_location.location == "A"
+    assert results["2"] is None
+    assert results["3"].last_location.location == "C"
+    assert helpers.results_cache.get(("acs", "2"))[1] is None
+
+@pytest.mark.parametrize("status", [404, 405, 501])
+def test_unsupported_batch_falls_back_to_track_one(status: int):
+    server = StandInTracker({"1": _package("A"), "2": _package("B")}, track_many_status=status)
+    results = asyncio.run(_lookup(server, ["1", "2"]))
+
+    assert [results[id].last_location.location for id in ["1", "2"]] == ["A", "B"]
+    assert server.requests == [("many", ["1", "2"]), ("one", "1"), ("one", "2")]
+
+    # Batching stays off for the courier until TRACKER_BATCH_RETRY has passed
+    helpers.results_cache.entries.clear()
+    server.requests.clear()
+    asyncio.run(_lookup(server, ["1", "2"]))
+    assert server.requests == [("one", "1"), ("one", "2")]
+
+def test_batching_is_retried_after_the_ttl():
+    server = StandInTracker({"1": _package("A"), "2": _package("B")}, track_many_status=404)
+    asyncio.run(_lookup(server, ["1", "2"]))
+
+    helpers._batch_unsupported.put("acs", True, ttl=0)
+    helpers.results_cache.entries.clear()
+    server.track_many_status = None
+    server.requests.clear()
+    asyncio.run(_lookup(server, ["1", "2"]))
+    assert server.requests == [("many", ["1", "2"])]
+
+def test_not_found_is_told_apart_from_a_failed_lookup():
+    server = StandInTracker({"1": {"found": False}, "2": {"found": True, "locations": "broken"}})
+    results = asyncio.run(_lookup(server, ["1", "2"]))
+
+    assert results["1"] is not None and not results["1"].found
+    assert results["2"] is None
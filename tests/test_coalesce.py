@@ -0,0 +1,27 @@
+import asyncio
+
+import helpers
+
+def test_caller_after_cancellation_gets_a_new_lookup():
+    # The only waiter of a lookup leaves, and the lookup takes a moment to unwind. A caller arriving
+    # in that moment must not join the dying lookup and get its CancelledError.
+    lookups = []
+
+    async def lookup(ids: list):
+        lookups.append(ids)
+        try:
+            await asyncio.sleep(0.2)
+        except asyncio.CancelledError:
+            await asyncio.sleep(0.05)
+            raise
+        return {id: "found" for id in ids}
+
+    async def run():
+        first = asyncio.ensure_future(helpers._coalesce("acs", ["1"], lookup))
+        await asyncio.sleep(0.01)
+        first.cancel()
+        await asyncio.sleep(0)
+        return await helpers._coalesce("acs", ["1"], lookup)
+
+    assert asyncio.run(run()) == {"1": "found"}
+    assert len(lookups) == 2
@@ -0,0 +1,24 @@
+import asyncio, logging
+
+import helpers, models
+
+def test_couriers_outside_the_id_format_are_asked_last(monkeypatch):
+    # A 10 digit id fits acs and geniki, but this one is elta's
+    asked = []
+
+    async def retrieve_package_info(logger, courier, id, max_age=None):
+        asked.append(courier)
+        if courier != "elta":
+            return None
+        location = models.Location("Athens", "In transit", "2026-10-01T10:00:00")
+        return models.TrackingResult(id, True, False, "", location, [location])
+
+    monkeypatch.setattr(helpers, "retrieve_package_info", retrieve_package_info)
+    helpers.detection_cache.discard("1234567890")
+
+    courier, package = asyncio.run(helpers.detect_courier(logging.getLogger("test"), "1234567890"))
+
+    candidates = helpers.candidate_couriers("1234567890")[0]
+    assert "elta" not in candidates
+    assert courier == "elta" and package.found
+    assert sorted(asked[:len(candidates)]) == sorted(candidates)
@@ -0,0 +1,61 @@
+import asyncio, discord, logging
+
+import helpers, models, notifications
+
+class _Response:
+    def __init__(self, status: int):
+        self.status = status
+        self.reason = "Bad Request"
+
+class _Channel:
+    # Rejects messages over Discord's limits the way Discord does, and messages with a rejected title
+    def __init__(self):
+        self.messages = []
+
+    async def send(self, embeds: list):
+        if len(embeds) > notifications.EMBEDS_PER_MESSAGE or sum(len(embed) for embed in embeds) > notifications.MESSAGE_EMBED_CHARACTERS:
+            raise discord.HTTPException(_Response(400), "Embed size exceeds maximum size of 6000")
+        if any(embed.title == "rejected" for embed in embeds):
+            raise discord.HTTPException(_Response(400), "Invalid Form Body")
+        self.messages.append(embeds)
+
+class _Bot:
+    def __init__(self, channel: _Channel):
+        self.channel = channel
+
+    def get_channel(self, id: int):
+        return self.channel
+
+def _update(title: str, events: int) -> discord.Embed:
+    location = models.Location("Athens", "In transit", "2026-10-01T10:00:00")
+    package = models.TrackingResult(title, True, False, "https://example.com/icon.png", location, [location] * (events + 1))
+    return helpers.status_embed(package, "acs", title, events=package.locations[:-1], history_limit=notifications.NOTIFY_HISTORY_LIMIT)
+
+def _deliver(updates: list, monkeypatch) -> tuple:
+    monkeypatch.setattr(notifications, "CHANNEL_RATE", (100, 1.0))
+    channel = _Channel()
+    dispatcher = notifications.Dispatcher(logging.getLogger("test"), _Bot(channel))
+    asyncio.run(dispatcher._deliver("1", [(embed, i) for i, embed in enumerate(updates)]))
+    return channel, dispatcher
+
+def test_long_updates_are_split_across_messages(monkeypatch):
+    updates = [_update(f"package {i}", 40) for i in range(10)]
+    assert all(len(embed) <= notifications.NOTIFY_HISTORY_LIMIT + 200 for embed in updates)
+
+    channel, dispatcher = _deliver(updates, monkeypatch)
+
+    assert len(channel.messages) > 1
+    assert sum(len(message) for message in channel.messages) == 10
+    assert dispatcher.failed == 0
+    assert sorted(dispatcher.handled) == list(range(10))
+
+def test_a_rejected_update_does_not_drop_the_rest(monkeypatch):
+    updates = [_update(f"package {i}", 1) for i in range(5)]
+    updates[2].title = "rejected"
+
+    channel, dispatcher = _deliver(updates, monkeypatch)
+
+    assert [embed.title for message in channel.messages for embed in message] == [f"package {i}" for i in (0, 1, 3, 4)]
+    assert dispatcher.sent == 4
+    assert dispatcher.failed == 1
+    assert sorted(dispatcher.handled) == list(range(5))